@@ -4,8 +4,8 @@ from django.db.models import signals
 
 from gypsy.dbfields.jsonfield import JSONField
 from gypsy.dbfields.picklefield import PickleField
-from gypsy.dbfields.related import ForeignKeyWithDefault, ForeignKeyUnrelated
-from gypsy.dbfields.listfield import StringListField, StringSetField
+from gypsy.dbfields.related import ForeignKeyWithDefault, ForeignKeyUnrelated, prefetch_related
+from gypsy.dbfields.listfield import StringListField, StringSetField, ListFieldManager
 
 class UniqueFilefield(models.FileField):
     """A version of FileField that doesn't check for other rows referencing
@@ -0,0 +1,54 @@
+"""Compressors for the serialized fields' compress option."""
+
+import zlib
+
+class ZlibCompressor(object):
+    name = "zlib"
+
+    def compress(self, data):
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class LZ4Compressor(object):
+    name = "lz4"
+
+    def __init__(self):
+        try:
+            # lz4 1.0 moved these, the block format with its size header is the same
+            from lz4.block import compress, decompress
+        except ImportError:
+            from lz4 import compress, decompress
+        self.compress = compress
+        self.decompress = decompress
+
+COMPRESSORS = {}
+
+def register_compressor(compressor_class):
+    """Make a compressor available if the module it needs is installed and usable."""
+    try:
+        compressor = compressor_class()
+    except (ImportError, AttributeError):
+        return
+    COMPRESSORS[compressor.name] = compressor
+
+for compressor_class in (ZlibCompressor, LZ4Compressor):
+    register_compressor(compressor_class)
+
+DEFAULT_THRESHOLD = 1024
+
+class CompressedField(object):
+    """
+    Mixin adding compress and compress_threshold options to a field.
+    Serialized payloads at least compress_threshold bytes long are
+    compressed with the named compressor.
+    """
+    def __init__(self, *args, **kwargs):
+        compress = kwargs.pop('compress', None)
+        self.compressor = compress and COMPRESSORS[compress]
+        self.compress_threshold = kwargs.pop('compress_threshold', DEFAULT_THRESHOLD)
+        super(CompressedField, self).__init__(*args, **kwargs)
+
+    def should_compress(self, data):
+        return self.compressor and len(data) >= self.compress_threshold
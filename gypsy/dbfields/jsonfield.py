@@ -1,23 +1,113 @@
+import base64
+
 try:
     from django.utils import simplejson
 except ImportError:
     import simplejson
 
+from django.conf import settings
 from django.db import models as django_models
 
-class JSONField(django_models.Field):
+from gypsy.dbfields.compression import COMPRESSORS, CompressedField
+from gypsy.dbfields.lazy import LazySerializedField, RawValue
+
+class JSONCodec(object):
+    name = "json"
+    binary = False
+
+    def dumps(self, value):
+        return simplejson.dumps(value)
+
+    def loads(self, data):
+        return simplejson.loads(data)
+
+class UltraJSONCodec(JSONCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.dumps = ujson.dumps
+        self.loads = ujson.loads
+
+class MessagePackCodec(JSONCodec):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        import msgpack
+        self.dumps = msgpack.packb
+        self.loads = msgpack.unpackb
+
+CODECS = {}
+
+def register_codec(codec_class):
+    """Make a codec available if the module it needs is installed."""
+    try:
+        codec = codec_class()
+    except ImportError:
+        return
+    CODECS[codec.name] = codec
+
+for codec_class in (JSONCodec, UltraJSONCodec, MessagePackCodec):
+    register_codec(codec_class)
+
+class JSONField(CompressedField, LazySerializedField, django_models.Field):
+    """
+    Stores any JSON serializable value in a text column.
+
+    Values are written as MAGIC followed by the JSON, or with another codec
+    (codec argument or settings.JSONFIELD_CODEC) as MAGIC:codec:payload
+    where binary payloads are base64 encoded. Values in any format are
+    readable whichever codec the field writes with. Lookups compare the
+    serialized value so they only match rows written with the same codec.
+
+    With lazy=True values are only decoded when the attribute is read. With
+    compress='zlib' (or 'lz4') payloads of at least compress_threshold bytes
+    are compressed and written as MAGIC:codec+compressor:base64.
+    """
     __metaclass__ = django_models.SubfieldBase
 
     MAGIC = "JSON"
 
+    def __init__(self, *args, **kwargs):
+        self.codec = CODECS[kwargs.pop('codec', None) or getattr(settings, 'JSONFIELD_CODEC', 'json')]
+        super(JSONField, self).__init__(*args, **kwargs)
+
     def to_python(self, value):
         if isinstance(value, basestring) and value.startswith(self.MAGIC):
-            value = simplejson.loads(value[len(self.MAGIC):])
+            value = value[len(self.MAGIC):]
+            if value.startswith(':'):
+                # Legacy JSON can't start with ':' so this is a codec tag
+                codec_name, value = value[1:].split(':', 1)
+                codec_name, plus, compressor_name = codec_name.partition('+')
+                codec = CODECS[codec_name]
+                if codec.binary or compressor_name:
+                    value = base64.b64decode(value)
+                if compressor_name:
+                    value = COMPRESSORS[compressor_name].decompress(value)
+                value = codec.loads(value)
+            else:
+                value = simplejson.loads(value)
 
         return value
 
+    def is_serialized(self, value):
+        return isinstance(value, basestring) and value.startswith(self.MAGIC)
+
     def get_db_prep_save(self, value):
-        return self.MAGIC + simplejson.dumps(value)
+        if isinstance(value, RawValue):
+            return value.data
+        data = self.codec.dumps(value)
+        if self.should_compress(data):
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            data = base64.b64encode(self.compressor.compress(data))
+            return "%s:%s+%s:%s" % (self.MAGIC, self.codec.name, self.compressor.name, data)
+        if self.codec.name == JSONCodec.name:
+            return self.MAGIC + data
+        if self.codec.binary:
+            data = base64.b64encode(data)
+        return "%s:%s:%s" % (self.MAGIC, self.codec.name, data)
     
     def get_internal_type(self): 
         return 'TextField'
@@ -0,0 +1,62 @@
+from django.db.models import signals
+
+class RawValue(object):
+    """Already serialized value that get_db_prep_save should pass through."""
+    def __init__(self, data):
+        self.data = data
+
+def raw_name(field):
+    """Name of the instance attribute holding a lazy field's undecoded value."""
+    return '_%s_raw' % field.attname
+
+class LazyDescriptor(object):
+    """
+    Replaces SubfieldBase's descriptor on lazy fields. Whatever is assigned
+    (including the raw value from the database) is kept as is and only run
+    through to_python the first time the attribute is read.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.raw_name = raw_name(field)
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        try:
+            return obj.__dict__[self.field.attname]
+        except KeyError:
+            value = obj.__dict__[self.field.attname] = self.field.to_python(obj.__dict__.get(self.raw_name))
+            return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.raw_name] = value
+        obj.__dict__.pop(self.field.attname, None)
+
+class LazySerializedField(object):
+    """
+    Mixin for serialized fields adding a lazy option. Lazy fields only
+    deserialize their value when it's read, and if it was never read the
+    value from the database is saved back without encoding it again.
+
+    Subclasses must implement is_serialized(value) and return RawValue.data
+    from get_db_prep_save.
+    """
+    def __init__(self, *args, **kwargs):
+        self.lazy = kwargs.pop('lazy', False)
+        super(LazySerializedField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(LazySerializedField, self).contribute_to_class(cls, name)
+        if self.lazy:
+            # SubfieldBase sets its own descriptor after this returns
+            signals.class_prepared.connect(self._set_lazy_descriptor, sender=cls, weak=False)
+
+    def _set_lazy_descriptor(self, sender, **kwargs):
+        setattr(sender, self.name, LazyDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        if self.lazy and self.attname not in model_instance.__dict__:
+            raw = model_instance.__dict__.get(raw_name(self))
+            if self.is_serialized(raw):
+                return RawValue(raw)
+        return super(LazySerializedField, self).pre_save(model_instance, add)
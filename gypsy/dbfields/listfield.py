@@ -1,17 +1,95 @@
+import re
+import operator
+
 from django.db import models
+from django.db.models import signals
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, Q
+
+INDEX_VALUE_LENGTH = 255
+ESCAPE = u'\\'
+
+# Lookups handled by ListFieldQuerySet. in_any is an alias for contains_any.
+LIST_LOOKUPS = ('contains', 'contains_all', 'contains_any', 'in_any')
 
 class BaseListField(models.Field):
+    """
+    Stores a list of strings in a text column as delim separated values.
+    Backslashes and delimiter characters inside values are escaped with a
+    backslash. Rows written before escaping are read as they were, except
+    that a backslash in front of a backslash or delimiter character is
+    taken as an escape (so an old u'a\\|b' now reads as u'a|b').
+
+    Querysets from ListFieldManager also support field__contains_all and
+    field__contains_any (or field__in_any) lookups. With indexed=True a side
+    table model (Model_field_index) holding one row per value is kept up to
+    date on save and those lookups, and field__contains, become indexed
+    joins against it. Existing rows can be indexed with rebuild_list_index.
+    """
     def __init__(self, *args, **kwargs):
         self.delim = kwargs.pop('delim', u'||')
+        self.indexed = kwargs.pop('indexed', False)
+        self.index_model = None
+        # Every backslash and delimiter character in a value gets escaped.
+        # Items are matched in turn with the delimiters between them so an
+        # unescaped delimiter character inside an old value doesn't split it.
+        delim = re.escape(self.delim)
+        special = re.escape(u"".join(set(self.delim + ESCAPE)))
+        self._escape_re = re.compile(u'([%s])' % special)
+        self._unescape_re = re.compile(ur'\\([%s])' % special)
+        self._item_re = re.compile(ur'((?:\\[%s]|(?!%s).)+)|%s' % (special, delim, delim), re.DOTALL)
         super(BaseListField, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(BaseListField, self).contribute_to_class(cls, name)
+        if self.indexed:
+            signals.class_prepared.connect(self._create_index_model, sender=cls, weak=False)
+
+    def _create_index_model(self, sender, **kwargs):
+        self.index_related_name = '%s_index' % self.name
+        meta = type('Meta', (), {
+            'app_label': sender._meta.app_label,
+            'unique_together': (('instance', 'value'),),
+        })
+        self.index_model = type('%s_%s_index' % (sender.__name__, self.name), (models.Model,), {
+            '__module__': sender.__module__,
+            'Meta': meta,
+            'instance': models.ForeignKey(sender, related_name=self.index_related_name),
+            'value': models.CharField(max_length=INDEX_VALUE_LENGTH, db_index=True),
+        })
+        signals.post_save.connect(self.update_index, sender=sender, weak=False)
+
+    def update_index(self, instance, **kwargs):
+        """Make the index rows for instance match its current values."""
+        values = set(value[:INDEX_VALUE_LENGTH] for value in self.iter_values(getattr(instance, self.attname)))
+        rows = self.index_model._default_manager.filter(instance=instance)
+        indexed = set(rows.values_list('value', flat=True))
+        if indexed - values:
+            rows.filter(value__in=list(indexed - values)).delete()
+        for value in values - indexed:
+            self.index_model._default_manager.create(instance=instance, value=value)
+
     def to_python(self, value):
         if isinstance(value, basestring):
-            value = [x for x in value.split(self.delim) if x]
+            value = list(self.iter_values(value))
         return value
 
+    def iter_values(self, value):
+        """Iterate over the items of a stored (or already parsed) value without building a list."""
+        if not isinstance(value, basestring):
+            return iter(value or ())
+        return (self._unescape(match.group(1)) for match in self._item_re.finditer(value) if match.group(1))
+
+    def _unescape(self, item):
+        if ESCAPE in item:
+            return self._unescape_re.sub(r'\1', item)
+        return item
+
+    def _escape(self, item):
+        return self._escape_re.sub(r'\\\1', item)
+
     def get_db_prep_save(self, value):
-        return u"%s%s%s" % (self.delim, self.delim.join(value), self.delim)
+        return u"%s%s%s" % (self.delim, self.delim.join(self._escape(x) for x in value), self.delim)
 
     def get_internal_type(self): 
         return 'TextField'
@@ -20,11 +98,11 @@ class BaseListField(models.Field):
         if lookup_type == 'exact':
             value = self.get_db_prep_save(value)
             return super(BaseListField, self).get_db_prep_lookup(lookup_type, value)
-        # elif lookup_type == 'in':
-        #     value = [self.get_db_prep_save(v) for v in value]
-        #     return super(BaseListField, self).get_db_prep_lookup(lookup_type, value)
+        elif lookup_type == 'in':
+            value = [self.get_db_prep_save(v) for v in value]
+            return super(BaseListField, self).get_db_prep_lookup(lookup_type, value)
         elif lookup_type == 'contains':
-            value = u"%s%s%s" % (self.delim, value, self.delim)
+            value = u"%s%s%s" % (self.delim, self._escape(value), self.delim)
             return super(BaseListField, self).get_db_prep_lookup(lookup_type, value)
         else:
             raise TypeError('Lookup type %s is not supported.' % lookup_type)
@@ -40,3 +118,63 @@ class StringSetField(BaseListField):
         if isinstance(value, (list, tuple)):
             value = set(value)
         return value
+
+class ListFieldQuerySet(QuerySet):
+    """
+    Adds field__contains_all, field__contains_any and field__in_any lookups
+    for list fields of the model, and runs them (and field__contains) as
+    joins against the index table of indexed fields. Only keyword lookups
+    on the model's own fields are rewritten.
+    """
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        args = list(args)
+        distinct = False
+        for key in kwargs.keys():
+            name, sep, lookup = key.partition('__')
+            if lookup not in LIST_LOOKUPS:
+                continue
+            try:
+                field = self.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not isinstance(field, BaseListField) or (lookup == 'contains' and not field.index_model):
+                continue
+
+            value = kwargs.pop(key)
+            if lookup == 'contains':
+                values, match_all = [value], True
+            else:
+                values, match_all = list(value), lookup == 'contains_all'
+
+            if field.index_model:
+                values = [v[:INDEX_VALUE_LENGTH] for v in values]
+                if match_all and len(values) == 1:
+                    args.append(Q(**{'%s__value' % field.index_related_name: values[0]}))
+                elif match_all:
+                    # A single join can't match several rows so use a subquery per value
+                    index = field.index_model._default_manager
+                    args.extend(Q(pk__in=index.filter(value=v).values_list('instance', flat=True)) for v in values)
+                else:
+                    args.append(Q(**{'%s__value__in' % field.index_related_name: values}))
+                    distinct = True
+            elif values:
+                conditions = [Q(**{'%s__contains' % name: v}) for v in values]
+                args.append(reduce(match_all and operator.and_ or operator.or_, conditions))
+            elif not match_all:
+                # Containing any of nothing never matches
+                args.append(Q(pk__in=[]))
+
+        queryset = super(ListFieldQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+        if distinct:
+            queryset = queryset.distinct()
+        return queryset
+
+class ListFieldManager(models.Manager):
+    def get_query_set(self):
+        return ListFieldQuerySet(self.model)
+
+def rebuild_list_index(model, field_name):
+    """Backfill the index table of an indexed list field from the existing rows."""
+    field = model._meta.get_field(field_name)
+    for instance in model._default_manager.all().iterator():
+        field.update_index(instance)
@@ -0,0 +1,4 @@
+"""
+The fields don't need any models of their own. This only lets dbfields be an
+app in Django so tests run.
+"""
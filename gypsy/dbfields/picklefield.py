@@ -1,44 +1,84 @@
 import base64
+import logging
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+from django.db import connection, transaction
 from django.db import models as django_models
 
+from gypsy.dbfields.compression import COMPRESSORS, CompressedField
+from gypsy.dbfields.lazy import LazySerializedField, RawValue
+
+# Start of the base64 encoded pickle of a _PickledMarker ("ccopy_reg\n_reconstructor")
+LEGACY_PREFIX = "Y2NvcHlfcmVnCl9yZWNvbnN0cnVjdG9y"
+
 class _PickledMarker(unicode):
+    """Wrapper the old format pickled values in. Only used to read old rows."""
     def __init__(self, object):
         self.object = object
         super(_PickledMarker, self).__init__()
 
 
-class PickleField(django_models.Field):
+def _load_legacy(value):
+    """Return (True, object) for an old format row or (False, None) if value isn't one."""
+    try:
+        unpickled = pickle.loads(base64.decodestring(value))
+    except:
+        return False, None
+    if isinstance(unpickled, _PickledMarker):
+        return True, unpickled.object
+    return False, None
+
+class PickleField(CompressedField, LazySerializedField, django_models.Field):
+    """
+    Stores any picklable value in a text column as MAGIC followed by the
+    base64 encoded pickle (highest protocol). The header is what tells
+    values from the database apart from values assigned by the user.
+    With compress='zlib' (or 'lz4') pickles of at least compress_threshold
+    bytes are compressed and written as COMPRESSED_MAGIC + compressor:base64.
+
+    Rows in the old format (base64 text pickles of a _PickledMarker) are
+    still read and can be rewritten with upgrade_legacy_rows. Lookups
+    compare the serialized value so they only match rows in the new format.
+    """
     __metaclass__ = django_models.SubfieldBase
-    
+
+    MAGIC = "PICKLE1:"
+    COMPRESSED_MAGIC = "PICKLE1+"
+
     def to_python(self, value):
-        try:
-            # test the object for unpickle-ability
-            unpickled = pickle.loads(base64.decodestring(value))
-        except:
-            # if it fails, then value is coming from the user, not the db
-            # and should be returned without further processing
-            pass
-        else:
-            # we could unpickle, but the value only came from the db 
-            # if it's an instance of _PickledMarker
-            if isinstance(unpickled, _PickledMarker):
-                return unpickled.object
-        
+        if isinstance(value, basestring):
+            try:
+                if value.startswith(self.MAGIC):
+                    return pickle.loads(base64.b64decode(value[len(self.MAGIC):]))
+                elif value.startswith(self.COMPRESSED_MAGIC):
+                    compressor_name, data = value[len(self.COMPRESSED_MAGIC):].split(':', 1)
+                    return pickle.loads(COMPRESSORS[compressor_name].decompress(base64.b64decode(data)))
+            except:
+                # Just a user value that happens to start with a header
+                return value
+            if value.startswith(LEGACY_PREFIX):
+                is_legacy, unpickled = _load_legacy(value)
+                if is_legacy:
+                    return unpickled
+
         return value
-    
-    def get_db_prep_save(self, value):
-        # ensure that any value is a _PickledMarker wrapper
-        # before saving it's serialization to the db
-        if not isinstance(value, _PickledMarker):
-            value = _PickledMarker(value)
 
-        return base64.encodestring(pickle.dumps(value))
+    def is_serialized(self, value):
+        return isinstance(value, basestring) and (value.startswith(self.MAGIC)
+            or value.startswith(self.COMPRESSED_MAGIC) or value.startswith(LEGACY_PREFIX))
+
+    def get_db_prep_save(self, value):
+        if isinstance(value, RawValue):
+            return value.data
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.should_compress(data):
+            return "%s%s:%s" % (self.COMPRESSED_MAGIC, self.compressor.name,
+                base64.b64encode(self.compressor.compress(data)))
+        return self.MAGIC + base64.b64encode(data)
     
     def get_internal_type(self): 
         return 'TextField'
@@ -52,3 +92,33 @@ class PickleField(django_models.Field):
             return super(PickleField, self).get_db_prep_lookup(lookup_type, value)
         else:
             raise TypeError('Lookup type %s is not supported.' % lookup_type)
+
+
+def upgrade_legacy_rows(model, field_name):
+    """
+    Rewrite the rows of model whose field_name is still in the old format.
+    Rows that can't be unpickled (say a pickled class was renamed) are left
+    alone and logged. Returns the number of rows converted and skipped.
+    """
+    field = model._meta.get_field(field_name)
+    manager = model._default_manager
+    converted = skipped = 0
+    # values_list returns the raw column so nothing gets unpickled needlessly
+    for pk, raw in manager.values_list('pk', field.attname).order_by('pk').iterator():
+        if isinstance(raw, basestring) and raw.startswith(LEGACY_PREFIX):
+            is_legacy, unpickled = _load_legacy(raw)
+            if not is_legacy:
+                logging.warning(u"Not upgrading %s %s: %s can't be unpickled" % (model.__name__, pk, field_name))
+                skipped += 1
+                continue
+            _update_raw(model, field, pk, field.get_db_prep_save(unpickled))
+            converted += 1
+    return converted, skipped
+
+def _update_raw(model, field, pk, value):
+    # Not QuerySet.update, whether it preps the value depends on the Django version
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %s SET %s = %%s WHERE %s = %%s" % (qn(model._meta.db_table),
+        qn(field.column), qn(model._meta.pk.column)), [value, pk])
+    transaction.commit_unless_managed()
@@ -1,6 +1,34 @@
+import threading
+
+from django.core import signals
 from django.db import models as django_models 
 from django.db.models.query import EmptyQuerySet
 
+# Defaults shared between instances through ForeignKeyWithDefault's
+# default_key. Per thread, cleared at the end of every request and
+# whenever it holds more than MAX_SHARED_DEFAULTS of them.
+MAX_SHARED_DEFAULTS = 1000
+
+_default_identity_map = threading.local()
+
+def clear_default_identity_map(**kwargs):
+    """Forget the shared defaults. Call it between jobs outside of requests."""
+    _default_identity_map.__dict__.clear()
+
+signals.request_finished.connect(clear_default_identity_map)
+
+def scoped_default_identity_map(func):
+    """Decorator for commands and tasks that share defaults only for the duration of each call."""
+    def wrapper(*args, **kwargs):
+        clear_default_identity_map()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            clear_default_identity_map()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 class EmptyManager(django_models.Manager):
     def get_query_set(self):
         return EmptyQuerySet()
@@ -30,26 +58,50 @@ class ForeignKeyUnrelated(django_models.ForeignKey):
         setattr(cls, related.get_accessor_name(), EmptyManager())
 
 
+# Counters for virtually related attributes. hits are accesses to an
+# instance's cached query set after it was evaluated, each one a query
+# saved. misses are the other accesses.
+virtual_related_stats = {'hits': 0, 'misses': 0, 'manager_classes': 0}
+
+_virtual_related_manager_classes = {}
+
 class _VirtualRelatedObjectsDescriptor(object):
     """
     This class serves to simplify template code
     by making commonly used query sets available
     as attributes of model instances.
     """
-    def __init__(self, getter):
+    def __init__(self, getter, cache=False):
         """
         The getter retrieves a query set to be wrapped
-        by a VirtualRelatedManager.
+        by a VirtualRelatedManager. With cache the query
+        set (and so its results) is kept on the instance
+        and reused on later accesses. Only the query set
+        is kept since the manager classes can't be pickled;
+        like any QuerySet it's evaluated when pickled.
         """
         self.getter = getter
-    
+        self.cache = cache
+        self.cache_name = '_%s_virtual_cache' % getter.__name__
+
     def __get__(self, instance, instance_type = None):
         if instance is None:
             raise AttributeError("Manager must be accessed via instance")
 
-        qs = self.getter(instance)
-        qs_type = type(qs.model._default_manager)
+        qs = None
+        if self.cache:
+            qs = instance.__dict__.get(self.cache_name)
+            if qs is not None and qs._result_cache is not None:
+                virtual_related_stats['hits'] += 1
+            else:
+                virtual_related_stats['misses'] += 1
 
+        if qs is None:
+            qs = self.getter(instance)
+            if self.cache:
+                instance.__dict__[self.cache_name] = qs
+
+        qs_type = type(qs.model._default_manager)
         VirtualRelatedManager = self.get_virtual_related_manager_cls(qs_type)
         return VirtualRelatedManager(qs)
 
@@ -57,6 +109,11 @@ class _VirtualRelatedObjectsDescriptor(object):
         raise AttributeError("VirtualManager cannot be set directly.")
 
     def get_virtual_related_manager_cls(self, supertype):
+        try:
+            return _virtual_related_manager_classes[supertype]
+        except KeyError:
+            pass
+
         class VirtualRelatedManager(supertype):
             """
             Makes all the common manager methods available, using
@@ -71,15 +128,21 @@ class _VirtualRelatedObjectsDescriptor(object):
         
             def get_query_set(self):
                 return self._query_set
+
+        _virtual_related_manager_classes[supertype] = VirtualRelatedManager
+        virtual_related_stats['manager_classes'] += 1
         return VirtualRelatedManager
 
 
-def virtually_related():
+def virtually_related(cache=False):
     """
     A more decorator syntax friendly way to add
     a VirtualRelatedObjectDescriptor to your class.
+    Pass cache=True to keep the results per instance.
     """
-    return _VirtualRelatedObjectsDescriptor
+    def decorator(getter):
+        return _VirtualRelatedObjectsDescriptor(getter, cache=cache)
+    return decorator
 
 
 class _ReverseSingleRelatedObjectDescriptorWithDefault(django_models.fields.related.ReverseSingleRelatedObjectDescriptor):
@@ -88,10 +151,30 @@ class _ReverseSingleRelatedObjectDescriptorWithDefault(django_models.fields.rela
     """
     def __init__(self, *args, **kwargs):
         self.null_default = kwargs.pop('null_default')
+        self.default_key = kwargs.pop('default_key', None)
         super(_ReverseSingleRelatedObjectDescriptorWithDefault, self).__init__(*args, **kwargs)
+        self.default_cache_name = '_%s_default_cache' % self.field.name
 
     def get_default(self, instance):
-        return self.null_default(instance)  # TODO: Cache instance instead of recreating everytime
+        try:
+            return getattr(instance, self.default_cache_name)
+        except AttributeError:
+            pass
+
+        if self.default_key is None:
+            default = self.null_default(instance)
+        else:
+            key = (self.field.model, self.field.name, self.default_key(instance))
+            shared = _default_identity_map.__dict__
+            try:
+                default = shared[key]
+            except KeyError:
+                if len(shared) >= MAX_SHARED_DEFAULTS:
+                    shared.clear()
+                default = shared[key] = self.null_default(instance)
+
+        setattr(instance, self.default_cache_name, default)
+        return default
 
     def __get__(self, instance, instance_type=None):
         if instance is None:
@@ -130,21 +213,75 @@ class _ReverseSingleRelatedObjectDescriptorWithDefault(django_models.fields.rela
             val = None
         setattr(instance, self.field.attname, val)
 
-        # Clear the cache, if it exists
-        try:
-            delattr(instance, self.field.get_cache_name())
-        except AttributeError:
-            pass
+        # Clear the caches, if they exist
+        for cache_name in (self.field.get_cache_name(), self.default_cache_name):
+            try:
+                delattr(instance, cache_name)
+            except AttributeError:
+                pass
 
 
 class ForeignKeyWithDefault(django_models.ForeignKey):
     """
     Subclass of ForeignKey that returns a user define value (null_default) when value is None
+
+    The default is created once per instance. If default_key is given it's
+    called with the instance and instances with the same key share a single
+    default for the rest of the request. Outside of requests use
+    clear_default_identity_map or scoped_default_identity_map to bound
+    how long defaults are shared.
     """
     def __init__(self, *args, **kwargs):
         self.null_default = kwargs.pop('null_default')
+        self.default_key = kwargs.pop('default_key', None)
         super(ForeignKeyWithDefault, self).__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name):
         super(ForeignKeyWithDefault, self).contribute_to_class(cls, name)
-        setattr(cls, self.name, _ReverseSingleRelatedObjectDescriptorWithDefault(self, null_default = self.null_default))
+        setattr(cls, self.name, _ReverseSingleRelatedObjectDescriptorWithDefault(self,
+            null_default = self.null_default, default_key = self.default_key))
+
+
+PREFETCH_CHUNK_SIZE = 500
+
+def prefetch_related(objects, *field_names, **kwargs):
+    """
+    Load the objects related through the named foreign keys for all objects
+    with IN queries of up to chunk_size ids, and cache them on each instance
+    so reading the fields doesn't query again. Works for any ForeignKey,
+    including ForeignKeyUnrelated and ForeignKeyWithDefault. Without
+    field_names every ForeignKeyUnrelated and ForeignKeyWithDefault field of
+    the model is prefetched. Returns the objects as a list.
+    """
+    chunk_size = kwargs.pop('chunk_size', PREFETCH_CHUNK_SIZE)
+    objects = list(objects)
+    if not objects:
+        return objects
+
+    opts = objects[0]._meta
+    if field_names:
+        fields = [opts.get_field(name) for name in field_names]
+    else:
+        fields = [f for f in opts.fields if isinstance(f, (ForeignKeyUnrelated, ForeignKeyWithDefault))]
+
+    for field in fields:
+        cache_name = field.get_cache_name()
+        rel_field = field.rel.get_related_field()
+
+        ids = set(getattr(obj, field.attname) for obj in objects if not hasattr(obj, cache_name))
+        ids.discard(None)
+        if not ids:
+            continue
+
+        ids = list(ids)
+        related = {}
+        for i in range(0, len(ids), chunk_size):
+            for rel_obj in field.rel.to._default_manager.filter(**{'%s__in' % rel_field.name: ids[i:i+chunk_size]}):
+                related[getattr(rel_obj, rel_field.attname)] = rel_obj
+
+        for obj in objects:
+            rel_obj = related.get(getattr(obj, field.attname))
+            if rel_obj is not None:
+                setattr(obj, cache_name, rel_obj)
+
+    return objects
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import base64
+import cPickle as pickle
+
+from django.db import connection, models
+from django.test import TestCase
+
+from gypsy.dbfields.compression import COMPRESSORS
+from gypsy.dbfields.listfield import ListFieldManager, StringListField, StringSetField
+from gypsy.dbfields.picklefield import PickleField, _PickledMarker, upgrade_legacy_rows
+
+class PickleModel(models.Model):
+    data = PickleField(null=True)
+    packed = PickleField(null=True, compress='zlib', compress_threshold=64)
+
+    class Meta:
+        app_label = 'dbfields'
+
+class ListModel(models.Model):
+    tags = StringListField(null=True)
+    labels = StringSetField(null=True, indexed=True)
+
+    objects = ListFieldManager()
+
+    class Meta:
+        app_label = 'dbfields'
+
+def legacy(value):
+    """A value the way the old PickleField stored it."""
+    return base64.encodestring(pickle.dumps(_PickledMarker(value)))
+
+def raw_value(obj, field_name):
+    return obj.__class__.objects.filter(pk=obj.pk).values_list(field_name, flat=True)[0]
+
+def set_raw_value(obj, field_name, value):
+    qn = connection.ops.quote_name
+    field = obj._meta.get_field(field_name)
+    connection.cursor().execute("UPDATE %s SET %s = %%s WHERE %s = %%s" % (qn(obj._meta.db_table),
+        qn(field.column), qn(obj._meta.pk.column)), [value, obj.pk])
+
+class PickleFieldTestCase(TestCase):
+    def setUp(self):
+        self.field = PickleModel._meta.get_field('data')
+
+    def testRoundTrip(self):
+        value = {'list': [1, 2.5, u"mit\u00e4"], 'none': None}
+        stored = self.field.get_db_prep_save(value)
+        self.failUnless(stored.startswith(PickleField.MAGIC))
+        self.failUnlessEqual(self.field.to_python(stored), value)
+        obj = PickleModel.objects.create(data=value)
+        self.failUnlessEqual(PickleModel.objects.get(pk=obj.pk).data, value)
+
+    def testLegacy(self):
+        self.failUnlessEqual(self.field.to_python(legacy([1, u"two"])), [1, u"two"])
+        obj = PickleModel.objects.create()
+        set_raw_value(obj, 'data', legacy({'a': 1}))
+        self.failUnlessEqual(PickleModel.objects.get(pk=obj.pk).data, {'a': 1})
+
+    def testMagicString(self):
+        value = "PICKLE1:not a pickle"
+        self.failUnlessEqual(self.field.to_python(value), value)
+        obj = PickleModel.objects.create(data=value)
+        self.failUnlessEqual(obj.data, value)
+        self.failUnlessEqual(PickleModel.objects.get(pk=obj.pk).data, value)
+
+    def testUpgradeLegacyRows(self):
+        current = PickleModel.objects.create(data=[1])
+        good = PickleModel.objects.create()
+        set_raw_value(good, 'data', legacy([2]))
+        # A truncated pickle still starts like a legacy row
+        broken = legacy([3])[:-12]
+        bad = PickleModel.objects.create()
+        set_raw_value(bad, 'data', broken)
+
+        self.failUnlessEqual(upgrade_legacy_rows(PickleModel, 'data'), (1, 1))
+        self.failUnless(raw_value(good, 'data').startswith(PickleField.MAGIC))
+        self.failUnlessEqual(PickleModel.objects.get(pk=good.pk).data, [2])
+        self.failUnlessEqual(raw_value(bad, 'data'), broken)
+        self.failUnlessEqual(PickleModel.objects.get(pk=current.pk).data, [1])
+        self.failUnlessEqual(upgrade_legacy_rows(PickleModel, 'data'), (0, 1))
+
+    def testCompressed(self):
+        field = PickleModel._meta.get_field('packed')
+        value = ["compressible"] * 100
+        stored = field.get_db_prep_save(value)
+        self.failUnless(stored.startswith(PickleField.COMPRESSED_MAGIC + "zlib:"))
+        self.failUnless(len(stored) < len(self.field.get_db_prep_save(value)))
+        self.failUnlessEqual(field.to_python(stored), value)
+        obj = PickleModel.objects.create(packed=value)
+        self.failUnlessEqual(PickleModel.objects.get(pk=obj.pk).packed, value)
+        # Small pickles aren't worth compressing
+        self.failUnless(field.get_db_prep_save([1]).startswith(PickleField.MAGIC))
+
+    def testCompressedMagicString(self):
+        field = PickleModel._meta.get_field('packed')
+        for value in ("PICKLE1+zlib:not compressed", "PICKLE1+nosuch:abc", "PICKLE1+"):
+            self.failUnlessEqual(field.to_python(value), value)
+            obj = PickleModel.objects.create(packed=value)
+            self.failUnlessEqual(PickleModel.objects.get(pk=obj.pk).packed, value)
+
+    def testCompressors(self):
+        data = "0123456789" * 100
+        for compressor in COMPRESSORS.values():
+            self.failUnlessEqual(compressor.decompress(compressor.compress(data)), data)
+
+def pks(queryset):
+    return sorted(obj.pk for obj in queryset)
+
+class ListFieldTestCase(TestCase):
+    def setUp(self):
+        self.field = ListModel._meta.get_field('tags')
+
+    def testEscaping(self):
+        values = [u"plain", u"a||b", u"pipe|", u"|lead", u"back\\slash", u"end\\", u"\\|", u"mit\u00e4"]
+        stored = self.field.get_db_prep_save(values)
+        self.failUnlessEqual(self.field.to_python(stored), values)
+        obj = ListModel.objects.create(tags=values, labels=values)
+        obj = ListModel.objects.get(pk=obj.pk)
+        self.failUnlessEqual(obj.tags, values)
+        self.failUnlessEqual(obj.labels, set(values))
+
+    def testLegacy(self):
+        # Rows from before escaping may have single delimiter characters in values
+        self.failUnlessEqual(self.field.to_python(u"||a|b||c||"), [u"a|b", u"c"])
+        self.failUnlessEqual(self.field.to_python(u"|||a||"), [u"|a"])
+        obj = ListModel.objects.create(tags=[], labels=[])
+        set_raw_value(obj, 'tags', u"||a|b||c||")
+        self.failUnlessEqual(ListModel.objects.get(pk=obj.pk).tags, [u"a|b", u"c"])
+        # Other backslashes are kept but escaped ones lose their backslash
+        self.failUnlessEqual(self.field.to_python(u"||C:\\temp||a\\|b||x\\\\y||"),
+            [u"C:\\temp", u"a|b", u"x\\y"])
+
+    def testLookups(self):
+        a = ListModel.objects.create(tags=[u"x", u"y"], labels=[u"x", u"y"])
+        b = ListModel.objects.create(tags=[u"y", u"z|"], labels=[u"y", u"z|"])
+        c = ListModel.objects.create(tags=[], labels=[])
+        objects = ListModel.objects
+
+        for name in ('tags', 'labels'):
+            def find(lookup, value):
+                return pks(objects.filter(**{'%s__%s' % (name, lookup): value}))
+            self.failUnlessEqual(find('contains', u"y"), [a.pk, b.pk])
+            self.failUnlessEqual(find('contains', u"z|"), [b.pk])
+            self.failUnlessEqual(find('contains', u"z"), [])
+            self.failUnlessEqual(find('contains_all', [u"x", u"y"]), [a.pk])
+            self.failUnlessEqual(find('contains_all', [u"y"]), [a.pk, b.pk])
+            self.failUnlessEqual(find('contains_all', [u"x", u"z|"]), [])
+            self.failUnlessEqual(find('contains_any', [u"x", u"y"]), [a.pk, b.pk])
+            self.failUnlessEqual(find('contains_any', [u"x", u"z|"]), [a.pk, b.pk])
+            self.failUnlessEqual(find('contains_any', []), [])
+            self.failUnlessEqual(find('in_any', [u"z|", u"nope"]), [b.pk])
+            self.failUnlessEqual(pks(objects.exclude(**{'%s__contains_any' % name: [u"x"]})), [b.pk, c.pk])
+
+        self.failUnlessEqual(pks(objects.filter(tags__in=[[u"x", u"y"], [u"nope"]])), [a.pk])
+        # Lookups combine with the normal ones
+        self.failUnlessEqual(pks(objects.filter(tags__contains_all=[u"y"], pk=b.pk)), [b.pk])
+
+        # The index follows changes
+        b.labels = [u"x"]
+        b.save()
+        self.failUnlessEqual(pks(objects.filter(labels__contains=u"x")), [a.pk, b.pk])
+        self.failUnlessEqual(pks(objects.filter(labels__contains=u"z|")), [])
@@ -0,0 +1,94 @@
+import os
+import time
+import random
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase, CreateError, MAX_SESSION_KEY
+from django.utils.hashcompat import md5_constructor
+
+MAX_CREATE_ATTEMPTS = 10 # New keys tried before giving up on storing a session
+STAMP_SUFFIX = ':stamp' # Key suffix of the separate version stamps gypsy.sessions.cached keeps
+
+def data_hash(data):
+    return md5_constructor(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+class DirtyTrackingSessionBase(SessionBase):
+    """
+    Base for session stores that only write when they have to.
+
+    A session isn't stored until it's first saved, so a load that misses
+    doesn't write anything. Saving a session whose data hasn't changed since
+    it was loaded is skipped unless less than SESSION_REFRESH_THRESHOLD
+    seconds (default is half the expiry age) are left before it expires.
+
+    Subclasses call _remember(data, expires_at, stamp=...) when load() finds
+    a session and implement _write(data, expires_at, must_create, stamp=None),
+    which must raise CreateError if must_create and the key is taken. stamp
+    is the version stamp gypsy.sessions.cached stores along with the data.
+    """
+    _persisted = False
+    _stored_hash = None
+    _stored_expires_at = None
+    _stored_stamp = None
+
+    def _remember(self, data, expires_at, data_hash_=None, stamp=None):
+        """Record what's stored for the session."""
+        self._persisted = True
+        self._stored_hash = data_hash_ or data_hash(data)
+        self._stored_expires_at = expires_at and int(expires_at)
+        self._stored_stamp = stamp
+
+    def _get_new_session_key(self):
+        # Sessions are created with an add that refuses existing keys so
+        # there's no need for the exists() round trip SessionBase makes
+        return md5_constructor("%s%s%s%s" % (random.randrange(0, MAX_SESSION_KEY),
+            os.getpid(), time.time(), settings.SECRET_KEY)).hexdigest()
+
+    def create(self):
+        # The new key is picked and stored by the first save
+        self._session_key = None
+        self._persisted = False
+        self._stored_hash = None
+        self.modified = True
+        self._session_cache = {}
+
+    def save(self, must_create=False):
+        data = self._get_session(no_load=must_create)
+        now = time.time()
+        expires_at = int(now + self.get_expiry_age())
+
+        if must_create:
+            self._write(data, expires_at, True)
+        elif not self._persisted:
+            for i in range(MAX_CREATE_ATTEMPTS):
+                try:
+                    self._write(data, expires_at, True)
+                except CreateError:
+                    # Key wasn't unique (or was never stored). Try another.
+                    self._session_key = None
+                    continue
+                break
+            else:
+                # A random key colliding this often means the store is down
+                raise RuntimeError("Unable to create a new session key. The session store is probably unavailable.")
+        else:
+            current_hash = data_hash(data)
+            if current_hash == self._stored_hash and self._stored_expires_at \
+                    and self._stored_expires_at - now > self._refresh_threshold():
+                return
+            self._write(data, expires_at, False)
+            self._remember(data, expires_at, current_hash)
+            return
+
+        self._remember(data, expires_at)
+
+    def _refresh_threshold(self):
+        threshold = getattr(settings, 'SESSION_REFRESH_THRESHOLD', None)
+        if threshold is None:
+            threshold = self.get_expiry_age() // 2
+        return threshold
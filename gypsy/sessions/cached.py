@@ -0,0 +1,148 @@
+"""
+Two tier session store.
+
+Keeps recently used sessions in a small per process LRU cache in front of
+another session backend. Every write stores a small version stamp (the
+data hash and expiry) with the session. A load with a cached copy only
+fetches that stamp and serves the copy if it matches, so writes and
+logouts in other processes are seen straight away without transferring
+and decoding the session. A load without one reads the stamp from the
+session record it fetches anyway. Entries older than SESSION_LOCAL_CACHE_TTL seconds or past
+the session's expiry are dropped regardless. Only real writes refresh the
+cached copy; saves skipped because nothing changed leave it alone.
+
+The backend's SessionStore must store the stamp passed to _write, pass it
+to _remember on load and implement _read_stamp(session_key) to fetch just
+the stamp (gypsy.sessions.memcachedb keeps a copy under its own key, set
+in the same request when updating; gypsy.sessions.tokyotyrant reads the
+stamp column alone). Sessions written before switching to this engine
+aren't cached until they're next saved.
+
+Settings:
+    SESSION_CACHED_BACKEND = Session engine to cache (default is 'gypsy.sessions.memcachedb')
+    SESSION_LOCAL_CACHE_SIZE = Number of sessions to keep per process (default is 1000)
+    SESSION_LOCAL_CACHE_TTL = Most seconds a cached session is kept for (default is 60)
+
+The cache counters are on gypsy.sessions.cached.local_cache.
+"""
+
+import time
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+
+backend = __import__(getattr(settings, 'SESSION_CACHED_BACKEND', 'gypsy.sessions.memcachedb'), {}, {}, [''])
+
+def make_stamp(data_hash, expires_at):
+    return "%s:%s" % (data_hash, expires_at)
+
+class LocalSessionCache(object):
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0 # Seconds spent loading from the backend on misses
+        self.validate_time = 0.0 # Seconds spent fetching stamps for cached copies
+        self._lock = threading.Lock()
+        self._entries = {} # session_key -> [pickled data, hash, expires_at, stamp, cached_at, last_used]
+        self._clock = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return total and float(self.hits) / total or 0.0
+
+    @property
+    def latency_saved(self):
+        """Estimated seconds of backend loads avoided by hits, less the time spent checking stamps."""
+        if not self.misses:
+            return 0.0
+        return self.hits * self.load_time / self.misses - self.validate_time
+
+    def get(self, session_key):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(session_key)
+            if entry is None:
+                return None
+            if now - entry[4] > self.ttl or (entry[2] and entry[2] < now):
+                del self._entries[session_key]
+                return None
+            self._clock += 1
+            entry[5] = self._clock
+            return entry[:4]
+        finally:
+            self._lock.release()
+
+    def set(self, session_key, pickled, data_hash, expires_at, stamp):
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._entries[session_key] = [pickled, data_hash, expires_at, stamp, time.time(), self._clock]
+            if len(self._entries) > self.size:
+                # Drop the least recently used tenth at once so this stays rare
+                by_age = sorted(self._entries.items(), key=lambda item: item[1][5])
+                for key, entry in by_age[:max(1, self.size // 10)]:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def delete(self, session_key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(session_key, None)
+        finally:
+            self._lock.release()
+
+local_cache = LocalSessionCache(
+    getattr(settings, 'SESSION_LOCAL_CACHE_SIZE', 1000),
+    getattr(settings, 'SESSION_LOCAL_CACHE_TTL', 60))
+
+class SessionStore(backend.SessionStore):
+    def load(self):
+        session_key = self.session_key
+        entry = local_cache.get(session_key)
+        if entry is not None:
+            start = time.time()
+            stamp = self._read_stamp(session_key)
+            local_cache.validate_time += time.time() - start
+            pickled, data_hash, expires_at, cached_stamp = entry
+            if stamp is not None and stamp == cached_stamp:
+                data = pickle.loads(pickled)
+                self._remember(data, expires_at, data_hash, cached_stamp)
+                local_cache.hits += 1
+                return data
+            local_cache.delete(session_key)
+
+        start = time.time()
+        data = super(SessionStore, self).load()
+        local_cache.misses += 1
+        local_cache.load_time += time.time() - start
+        # The stamp was written with the data so it describes exactly what
+        # was loaded. Sessions written before this engine was used have none.
+        if self._persisted and self._stored_stamp is not None:
+            local_cache.set(session_key, pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+                self._stored_hash, self._stored_expires_at, self._stored_stamp)
+        return data
+
+    def _write(self, data, expires_at, must_create, stamp=None):
+        pickled = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        data_hash = md5_constructor(pickled).hexdigest()
+        stamp = make_stamp(data_hash, expires_at)
+        super(SessionStore, self)._write(data, expires_at, must_create, stamp)
+        local_cache.set(self.session_key, pickled, data_hash, expires_at, stamp)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self._session_key
+        if session_key is not None:
+            local_cache.delete(session_key)
+        super(SessionStore, self).delete(session_key)
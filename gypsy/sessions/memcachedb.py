@@ -1,54 +1,88 @@
+import threading
+
 import memcache
 from django.conf import settings
-from django.contrib.sessions.backends.base import SessionBase, CreateError
+from django.contrib.sessions.backends.base import CreateError
+
+from gypsy.sessions.base import DirtyTrackingSessionBase, STAMP_SUFFIX
 
 DEFAULT_PORT = 21201
 
-class SessionStore(SessionBase):
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Return the process wide memcachedb client, building it on first use.
+    memcache.Client is thread local so every thread gets its own persistent
+    sockets. Servers that fail are skipped for SESSION_MEMCACHEDB_DEAD_RETRY
+    seconds before being tried again.
+    """
+    global _client
+    if _client is None:
+        _client_lock.acquire()
+        try:
+            if _client is None:
+                # memcachedb uses a different default port than memcache. So, if the
+                # port isn't specified then force it to the default memcachedb port
+                servers = []
+                for host in settings.SESSION_MEMCACHEDB_SERVERS:
+                    if ':' not in host:
+                        host = '%s:%d' % (host, DEFAULT_PORT)
+                    servers.append(host)
+                kwargs = {}
+                if hasattr(settings, 'SESSION_MEMCACHEDB_DEAD_RETRY'):
+                    kwargs['dead_retry'] = settings.SESSION_MEMCACHEDB_DEAD_RETRY
+                if hasattr(settings, 'SESSION_MEMCACHEDB_SOCKET_TIMEOUT'):
+                    kwargs['socket_timeout'] = settings.SESSION_MEMCACHEDB_SOCKET_TIMEOUT
+                _client = memcache.Client(servers, memcachedb=True, **kwargs)
+        finally:
+            _client_lock.release()
+    return _client
+
+def check_servers():
+    """Return the servers that currently answer a stats request."""
+    return [name.split(' ')[0] for name, stats in get_client().get_stats()]
+
+class SessionStore(DirtyTrackingSessionBase):
     """
     A memcachedb based session store.
     """
     def __init__(self, session_key=None):
-        # memcachedb uses a different default port than memcache. So, if the
-        # port isn't specified then force it to the default memcachedb port
-        servers = []
-        for host in settings.SESSION_MEMCACHEDB_SERVERS:
-            if ':' not in host:
-                host = '%s:%d' % (host, DEFAULT_PORT)
-            servers.append(host)
-        self._conn = memcache.Client(servers, memcachedb=True)
+        self._conn = get_client()
         super(SessionStore, self).__init__(session_key)
 
     def load(self):
         session_data = self._conn.get(self.session_key)
         if session_data is not None:
+            self._remember(session_data['data'], session_data.get('expires_at'), stamp=session_data.get('stamp'))
             return session_data['data']
-        self.create()
+        # Unknown key, a new one is picked when the session is first saved
+        self._session_key = None
         return {}
 
-    def create(self):
-        while True:
-            self.session_key = self._get_new_session_key()
-            try:
-                # Save immediately to ensure we have a unique entry
-                self.save(must_create=True)
-            except CreateError:
-                # Key wasn't unique. Try again.
-                continue
-            self.modified = True
-            self._session_cache = {}
-            return
-
-    def save(self, must_create=False):
+    def _write(self, data, expires_at, must_create, stamp=None):
         if must_create:
             func = self._conn.add
         else:
             func = self._conn.set
         data = dict(
-            data = self._get_session(no_load=must_create),
+            data = data,
             expires = self.get_expiry_age(),
+            expires_at = expires_at,
         )
-        result = func(self.session_key, data) #, self.get_expiry_age())
+        if stamp is None:
+            result = func(self.session_key, data) #, self.get_expiry_age())
+        else:
+            # The stamp is also kept under its own key so it can be checked
+            # without fetching the session
+            data['stamp'] = stamp
+            if must_create:
+                result = func(self.session_key, data)
+                if result:
+                    self._conn.set(self.session_key + STAMP_SUFFIX, stamp)
+            else:
+                result = not self._conn.set_multi({self.session_key: data, self.session_key + STAMP_SUFFIX: stamp})
         if must_create and not result:
             raise CreateError
 
@@ -60,4 +94,7 @@ class SessionStore(SessionBase):
             if self._session_key is None:
                 return
             session_key = self._session_key
-        self._conn.delete(session_key)
+        self._conn.delete_multi([session_key, session_key + STAMP_SUFFIX])
+
+    def _read_stamp(self, session_key):
+        return self._conn.get(session_key + STAMP_SUFFIX)
@@ -0,0 +1,4 @@
+"""
+The session stores don't need any models. This only lets sessions be an app
+in Django so tests run.
+"""
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import time
+
+from django.test import TestCase
+
+from gypsy.sessions import memcachedb
+from gypsy.sessions.base import MAX_CREATE_ATTEMPTS
+
+class FakeClient(object):
+    """Dict backed stand-in for memcache.Client that counts writes."""
+    def __init__(self):
+        self.data = {}
+        self.writes = 0
+        self.adds = 0
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.writes += 1
+        self.data[key] = value
+        return True
+
+    def add(self, key, value):
+        self.adds += 1
+        if key in self.data:
+            return 0
+        return self.set(key, value)
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+        return []
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+        return 1
+
+class DeadClient(FakeClient):
+    """What memcache.Client does when no server answers."""
+    def add(self, key, value):
+        self.adds += 1
+        return 0
+
+class SessionSaveTestCase(TestCase):
+    def setUp(self):
+        self.old_client = memcachedb._client
+        self.client = memcachedb._client = FakeClient()
+
+    def tearDown(self):
+        memcachedb._client = self.old_client
+
+    def stored_session(self, **data):
+        session = memcachedb.SessionStore()
+        session.update(data)
+        session.save()
+        self.client.writes = 0
+        return session.session_key
+
+    def testMissDoesntWrite(self):
+        session = memcachedb.SessionStore('nosuchkey')
+        self.failUnlessEqual(session.get('a'), None)
+        self.failUnlessEqual(self.client.writes, 0)
+        session['a'] = 1
+        session.save()
+        self.failUnlessEqual(self.client.writes, 1)
+        self.failIfEqual(session.session_key, 'nosuchkey')
+        self.failUnlessEqual(self.client.data[session.session_key]['data'], {'a': 1})
+
+    def testUnchangedSaveSkipped(self):
+        key = self.stored_session(a=1)
+        session = memcachedb.SessionStore(key)
+        self.failUnlessEqual(session['a'], 1)
+        session.save()
+        self.failUnlessEqual(self.client.writes, 0)
+
+    def testChangedSave(self):
+        key = self.stored_session(a=1)
+        session = memcachedb.SessionStore(key)
+        session['a'] = 2
+        session.save()
+        self.failUnlessEqual(self.client.writes, 1)
+        self.failUnlessEqual(self.client.data[key]['data'], {'a': 2})
+        # Saving the same data again isn't needed
+        session.save()
+        self.failUnlessEqual(self.client.writes, 1)
+
+    def testRefresh(self):
+        key = self.stored_session(a=1)
+        expires_at = int(time.time()) + 10
+        self.client.data[key]['expires_at'] = expires_at
+        session = memcachedb.SessionStore(key)
+        self.failUnlessEqual(session['a'], 1)
+        session.save()
+        self.failUnlessEqual(self.client.writes, 1)
+        self.failUnless(self.client.data[key]['expires_at'] > expires_at)
+
+    def testStoreUnavailable(self):
+        self.client = memcachedb._client = DeadClient()
+        session = memcachedb.SessionStore()
+        session['a'] = 1
+        self.failUnlessRaises(RuntimeError, session.save)
+        self.failUnlessEqual(self.client.adds, MAX_CREATE_ATTEMPTS)
+        self.failUnlessEqual(self.client.data, {})
@@ -1,60 +1,174 @@
 import time
+import operator
+import socket
+import threading
+
 import pytyrant
 from django.conf import settings
 from django.core.exceptions import SuspiciousOperation
-from django.contrib.sessions.backends.base import SessionBase, CreateError
+from django.contrib.sessions.backends.base import CreateError
+
+from gypsy.sessions.base import DirtyTrackingSessionBase
+
+_local = threading.local()
+
+def get_tyrant():
+    """Return the current thread's Tyrant connection, opening it on first use."""
+    tyrant = getattr(_local, 'tyrant', None)
+    if tyrant is None:
+        tyrant = _local.tyrant = pytyrant.PyTableTyrant.open(*settings.SESSION_TT_ADDR)
+    return tyrant
+
+def reset_tyrant():
+    """Drop the current thread's connection so the next call reconnects."""
+    tyrant = getattr(_local, 'tyrant', None)
+    _local.tyrant = None
+    if tyrant is not None:
+        try:
+            tyrant.t.sock.close()
+        except socket.error:
+            pass
+
+def with_tyrant(func, *args):
+    """Call func(tyrant, *args) reconnecting and trying again once if the connection was lost."""
+    try:
+        return func(get_tyrant(), *args)
+    except socket.error:
+        reset_tyrant()
+        return func(get_tyrant(), *args)
+
+# Table database constants from tctdb.h, pytyrant's own where it has them
+ITDECIMAL = getattr(pytyrant, 'RDBITDECIMAL', 1) # Numeric index type
+ITKEEP = getattr(pytyrant, 'RDBITKEEP', 1 << 24) # Keep an existing index instead of rebuilding it
+QCNUMLE = getattr(pytyrant, 'RDBQCNUMLE', 12) # Number less than or equal to
+QONUMASC = getattr(pytyrant, 'RDBQONUMASC', 2) # Numeric ascending order
+QCSTREQ = getattr(pytyrant, 'RDBQCSTREQ', 0) # String equal to
+
+class ExpiredSessionCleaner(object):
+    """
+    Deletes expired sessions in bounded batches.
+
+    Makes sure the expires column has a numeric index, then repeatedly
+    looks up at most batch_size keys that expired before the sweep started
+    and removes them with one outlist call, sleeping pause seconds between
+    batches. Each batch only touches the oldest sessions so a sweep can be
+    stopped at any point and the next run() carries on where it left off.
+    progress(deleted, batches) is called after every batch.
+
+    Settings:
+        SESSION_TT_CLEAN_BATCH = Sessions deleted per batch (default is 1000)
+        SESSION_TT_CLEAN_PAUSE = Seconds to sleep between batches (default is 0.1)
+    """
+    def __init__(self, batch_size=None, pause=None, progress=None):
+        self.batch_size = batch_size or getattr(settings, 'SESSION_TT_CLEAN_BATCH', 1000)
+        if pause is None:
+            pause = getattr(settings, 'SESSION_TT_CLEAN_PAUSE', 0.1)
+        self.pause = pause
+        self.progress = progress
+        self.deleted = 0
+        self.batches = 0
+        self._indexed = False
+
+    def ensure_index(self):
+        if not self._indexed:
+            try:
+                with_tyrant(lambda tyrant: tyrant.t.misc("setindex", 0, ["expires", str(ITDECIMAL | ITKEEP)]))
+            except pytyrant.TyrantError, exc:
+                # With ITKEEP an existing index makes setindex fail
+                if exc.message != 1:
+                    raise
+            self._indexed = True
 
-class SessionStore(SessionBase):
+    def expired_keys(self, cutoff):
+        return with_tyrant(lambda tyrant: tyrant.t.misc("search", 0, [
+            "addcond\x00expires\x00%d\x00%d" % (QCNUMLE, cutoff),
+            "setorder\x00expires\x00%d" % QONUMASC,
+            "setlimit\x00%d\x000" % self.batch_size,
+        ]))
+
+    def delete_keys(self, keys):
+        try:
+            with_tyrant(lambda tyrant: tyrant.t.misc("outlist", 0, keys))
+        except pytyrant.TyrantError, exc:
+            # Some of the keys were already gone, the rest are deleted
+            if exc.message != 1:
+                raise
+
+    def run_batch(self, cutoff=None):
+        """Delete one batch of sessions that expired before cutoff and return how many were found."""
+        self.ensure_index()
+        if cutoff is None:
+            cutoff = int(time.time())
+        keys = self.expired_keys(cutoff)
+        if keys:
+            self.delete_keys(keys)
+            self.deleted += len(keys)
+            self.batches += 1
+            if self.progress is not None:
+                self.progress(self.deleted, self.batches)
+        return len(keys)
+
+    def run(self, max_batches=None):
+        """Delete sessions that expired before now, at most max_batches batches of them, and return the total deleted."""
+        cutoff = int(time.time())
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if batches and self.pause:
+                time.sleep(self.pause)
+            found = self.run_batch(cutoff)
+            batches += 1
+            if found < self.batch_size:
+                break
+        return self.deleted
+
+class SessionStore(DirtyTrackingSessionBase):
     """
     A Tokyo Tyrant based session store.
+
+    Connections are kept open per thread and shared by every session, and
+    are reopened if the server drops them.
     """
-    def __init__(self, session_key=None):
-        self._tyrant = pytyrant.PyTableTyrant.open(*settings.SESSION_TT_ADDR)
-        super(SessionStore, self).__init__(session_key)
+    @property
+    def _tyrant(self):
+        return get_tyrant()
 
     def load(self):
         try:
-            session_data = self._tyrant[self.session_key]
+            session_data = with_tyrant(operator.getitem, self.session_key)
         except KeyError:
-            self.create()
+            # Unknown key, a new one is picked when the session is first saved
+            self._session_key = None
             return {}
 
         if int(session_data['expires']) < time.time():
             return {}
 
         try:
-            return self.decode(session_data['data'])
+            data = self.decode(session_data['data'])
         except SuspiciousOperation:
             return {}
+        self._remember(data, session_data['expires'], stamp=session_data.get('stamp'))
+        return data
 
-    def create(self):
-        while True:
-            self.session_key = self._get_new_session_key()
-            try:
-                self.save(must_create=True)
-            except CreateError:
-                continue
-            self.modified = True
-            self._session_cache = {}
-            return
-
-    def save(self, must_create=False):
+    def _write(self, data, expires_at, must_create, stamp=None):
         data = dict(
-            data = self.encode(self._get_session(no_load=must_create)),
-            expires = str(int(time.time() + self.get_expiry_age())),
+            data = self.encode(data),
+            expires = str(expires_at),
         )
+        if stamp is not None:
+            data['stamp'] = stamp
         if must_create:
             try:
-                self._tyrant.t.misc("putkeep", 0, [self.session_key] + pytyrant.dict_to_list(data))
+                with_tyrant(lambda tyrant: tyrant.t.misc("putkeep", 0, [self.session_key] + pytyrant.dict_to_list(data)))
             except pytyrant.TyrantError, exc:
                 if exc.message == 1:
                     raise CreateError()
                 raise
         else:
-            self._tyrant[self.session_key] = data
+            with_tyrant(operator.setitem, self.session_key, data)
 
     def exists(self, session_key):
-        return bool(self._tyrant.get(session_key))
+        return bool(with_tyrant(lambda tyrant: tyrant.get(session_key)))
 
     def delete(self, session_key=None):
         if session_key is None:
@@ -62,12 +176,23 @@ class SessionStore(SessionBase):
                 return
             session_key = self._session_key
         try:
-            del self._tyrant[session_key]
+            with_tyrant(operator.delitem, session_key)
         except KeyError:
             pass
 
+    def _read_stamp(self, session_key):
+        # Search by primary key and fetch only the stamp column
+        records = with_tyrant(lambda tyrant: tyrant.t.misc("search", 0, [
+            "addcond\x00\x00%d\x00%s" % (QCSTREQ, session_key),
+            "setlimit\x001\x000",
+            "get\x00stamp",
+        ]))
+        if not records:
+            return None
+        # Each record is zero separated column names and values with the
+        # primary key under an empty name
+        parts = records[0].split('\x00')
+        return dict(zip(parts[0::2], parts[1::2])).get('stamp')
+
     def clean(self):
-        q = pytyrant.Query(self._tyrant)
-        q = q.filter(expires__numle=str(int(time.time())))
-        for x in q:
-            del self._tyrant[x]
+        ExpiredSessionCleaner().run()
@@ -0,0 +1,217 @@
+"""
+Read-through disk cache in front of another storage backend.
+
+Files opened through the cache are copied to a local directory and served
+from disk on later opens. The directory is managed with FileSystemStorage
+so paths are resolved the same way as local media. When the cache grows
+past MAX_SIZE bytes the least recently used files are removed. Files
+bigger than MAX_SIZE aren't cached and are read from the backend. Files
+already in the directory are picked up when the cache is created so they
+count towards MAX_SIZE after a restart.
+
+If the backend has an etag(name) method (S3Storage does) cached files are
+revalidated against it before being served, which costs a HEAD request
+instead of a full download.
+
+Settings are specified in settings.STORAGE_CACHE:
+    LOCATION = Directory to store cached files (default is gypsy.storage.backends.filesystem.FileSystemStorage's location + 'cache/')
+    MAX_SIZE = Maximum total bytes of cached files (default is 1GB)
+    REVALIDATE = If cached files should be checked against the backend's ETag (default is True)
+"""
+
+import os
+import threading
+from tempfile import mkstemp
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import Storage, FileSystemStorage
+
+TMP_PREFIX = '.fetching-'
+CHUNK_SIZE = 64 * 1024
+
+class CachedStorage(Storage):
+    def __init__(self, backend, location=None, max_size=None, revalidate=None):
+        conf = getattr(settings, 'STORAGE_CACHE', {})
+        self.backend = backend
+        location = location or conf.get('LOCATION')
+        if not location:
+            # Imported here since it needs FILESYSTEM_STORAGE_POSTFIX
+            from gypsy.storage.backends.filesystem import FileSystemStorage as DefaultStorage
+            location = os.path.join(DefaultStorage().location, 'cache')
+        self.cache = FileSystemStorage(location)
+        self.max_size = max_size or conf.get('MAX_SIZE', 1024*1024*1024)
+        self.revalidate = revalidate if revalidate is not None else conf.get('REVALIDATE', True)
+        self.revalidate = self.revalidate and hasattr(backend, 'etag')
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = {} # name -> [size, etag, last_used]
+        self._total_size = 0
+        self._clock = 0
+        self._load_entries()
+
+    def _load_entries(self):
+        """Index the files already in the cache directory, oldest first."""
+        found = []
+        for root, dirs, files in os.walk(self.cache.location):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    if filename.startswith(TMP_PREFIX):
+                        # Left over from an interrupted fetch
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, self.cache.location).replace(os.sep, '/')
+                found.append((stat.st_mtime, name, stat.st_size))
+        found.sort()
+        for mtime, name, size in found:
+            self._clock += 1
+            # The ETag isn't known so revalidation fetches these again
+            self._entries[name] = [size, None, self._clock]
+            self._total_size += size
+        if self._total_size > self.max_size:
+            self._evict()
+
+    def _open(self, name, mode='rb'):
+        path = self.cache.path(name)
+        etag = self.revalidate and self.backend.etag(name) or None
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(name)
+            hit = entry is not None and (not self.revalidate or entry[1] == etag)
+            if hit:
+                self.hits += 1
+                self._clock += 1
+                entry[2] = self._clock
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+        if hit:
+            try:
+                return File(open(path, mode))
+            except IOError:
+                # Removed from under us, fall through and fetch it again
+                self.invalidate(name)
+
+        if self._fetch(name, path, etag):
+            try:
+                return File(open(path, mode))
+            except IOError:
+                # Evicted by another thread before we got to open it
+                pass
+        return self.backend.open(name, mode)
+
+    def _fetch(self, name, path, etag):
+        """Copy a file from the backend into the cache. Returns False if it's too big to cache."""
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread or process
+                if not os.path.isdir(directory):
+                    raise
+
+        src = self.backend.open(name, 'rb')
+        chunk = src.read(CHUNK_SIZE)
+        # Reading first means S3 files know their size without another request
+        if src.size > self.max_size:
+            src.close()
+            return False
+
+        fd, tmp_path = mkstemp(prefix=TMP_PREFIX, dir=directory)
+        try:
+            size = 0
+            try:
+                while chunk:
+                    os.write(fd, chunk)
+                    size += len(chunk)
+                    chunk = src.read(CHUNK_SIZE)
+            finally:
+                os.close(fd)
+                src.close()
+            # Rename so readers never see a partially written file
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        self._lock.acquire()
+        try:
+            old = self._entries.get(name)
+            if old is not None:
+                self._total_size -= old[0]
+            self._clock += 1
+            self._entries[name] = [size, etag, self._clock]
+            self._total_size += size
+            if self._total_size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+        return True
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits in max_size. Lock must be held."""
+        by_age = sorted(self._entries.items(), key=lambda item: item[1][2])
+        for name, entry in by_age:
+            if self._total_size <= self.max_size:
+                break
+            del self._entries[name]
+            self._total_size -= entry[0]
+            self.evictions += 1
+            try:
+                os.remove(self.cache.path(name))
+            except OSError:
+                pass
+
+    def invalidate(self, name):
+        """Drop a file from the cache."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._total_size -= entry[0]
+        finally:
+            self._lock.release()
+        try:
+            os.remove(self.cache.path(name))
+        except OSError:
+            pass
+
+    def _save(self, name, content):
+        self.invalidate(name)
+        name = self.backend._save(name, content)
+        self.invalidate(name)
+        return name
+
+    def get_valid_name(self, name):
+        return self.backend.get_valid_name(name)
+
+    def get_available_name(self, name):
+        return self.backend.get_available_name(name)
+
+    def delete(self, name):
+        self.invalidate(name)
+        return self.backend.delete(name)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def size(self, name):
+        return self.backend.size(name)
+
+    def url(self, name, *args, **kwargs):
+        return self.backend.url(name, *args, **kwargs)
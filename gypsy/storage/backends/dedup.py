@@ -0,0 +1,141 @@
+"""
+Content addressed storage backend for Django.
+
+Wraps another backend (S3Storage, FileSystemStorage, MemoryStorage, ...)
+and stores each distinct content once under its SHA-1 digest. Names are
+mapped to digests through an index, by default the BlobName model, and a
+blob is only deleted from the backend once no names reference it. Saving
+content that's already stored doesn't upload anything. Pointing a name at
+a blob and deleting an unreferenced blob are done under a lock per digest
+(gypsy.utils.locker, when memcache is the cache backend) so a save can't
+reuse a blob that a concurrent delete is removing. Blob names have no
+extension so the content type guessed from the saved name is passed to the
+backend as content.mimetype (S3Storage stores it).
+
+Settings are specified in settings.STORAGE_DEDUP:
+    PREFIX = Prefix of blob names in the backend (default is 'blobs/')
+"""
+
+import logging
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.files.storage import Storage
+
+from gypsy.storage.models import BlobName
+from gypsy.utils.locker import locker
+from gypsy.utils.mimetype import guess_type
+
+class ModelIndex(object):
+    """Name to digest index kept in the BlobName model."""
+
+    def get(self, name):
+        try:
+            return BlobName.objects.get(name=name).digest
+        except BlobName.DoesNotExist:
+            return None
+
+    def set(self, name, digest):
+        """Point name at digest and return the digest it replaced (if any)."""
+        try:
+            blob_name = BlobName.objects.get(name=name)
+        except BlobName.DoesNotExist:
+            BlobName.objects.create(name=name, digest=digest)
+            return None
+        old_digest = blob_name.digest
+        blob_name.digest = digest
+        blob_name.save()
+        return old_digest
+
+    def remove(self, name):
+        """Remove name and return the digest it pointed at (if any)."""
+        digest = self.get(name)
+        BlobName.objects.filter(name=name).delete()
+        return digest
+
+    def references(self, digest):
+        return BlobName.objects.filter(digest=digest).count()
+
+class DedupStorage(Storage):
+    def __init__(self, backend, index=None, prefix=None):
+        self.backend = backend
+        self.index = index or ModelIndex()
+        self.prefix = prefix or getattr(settings, 'STORAGE_DEDUP', {}).get('PREFIX', 'blobs/')
+
+    def blob_name(self, digest):
+        return "%s%s/%s/%s" % (self.prefix, digest[:2], digest[2:4], digest)
+
+    def _digest(self, content):
+        digest = sha1()
+        if hasattr(content, 'chunks'):
+            for chunk in content.chunks():
+                digest.update(chunk)
+        else:
+            content.seek(0)
+            while True:
+                chunk = content.read(64*1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _blob_name_for(self, name):
+        digest = self.index.get(name)
+        if digest is None:
+            raise IOError("No such file: '%s'" % name)
+        return self.blob_name(digest)
+
+    def _open(self, name, mode='rb'):
+        return self.backend.open(self._blob_name_for(name), mode)
+
+    def _lock_name(self, digest):
+        return "dedup:%s" % digest
+
+    def _save(self, name, content):
+        digest = self._digest(content)
+        # Reference the blob before uploading it so a delete of another name
+        # can't remove it, and upload if no other name was keeping it
+        with locker(self._lock_name(digest)):
+            old_digest = self.index.set(name, digest)
+            upload = old_digest != digest and self.index.references(digest) == 1
+        if upload:
+            content.seek(0)
+            if not getattr(content, 'mimetype', None):
+                content.mimetype = guess_type(name)[0]
+            try:
+                # Call _save directly so the backend doesn't rename the blob
+                self.backend._save(self.blob_name(digest), content)
+            except:
+                # Point the name back at what it was so it isn't left dangling
+                if old_digest:
+                    self.index.set(name, old_digest)
+                else:
+                    self.index.remove(name)
+                raise
+        if old_digest and old_digest != digest:
+            self._release(old_digest)
+        return name
+
+    def _release(self, digest):
+        """Delete the blob for digest if nothing references it anymore."""
+        with locker(self._lock_name(digest)):
+            if self.index.references(digest):
+                return
+            self.backend.delete(self.blob_name(digest))
+            if self.index.references(digest):
+                # Only possible without a lock, a save reused the blob meanwhile
+                logging.error(u"Deleted blob %s while it was being referenced" % digest)
+
+    def delete(self, name):
+        digest = self.index.remove(name)
+        if digest:
+            self._release(digest)
+
+    def exists(self, name):
+        return self.index.get(name) is not None
+
+    def size(self, name):
+        return self.backend.size(self._blob_name_for(name))
+
+    def url(self, name, *args, **kwargs):
+        return self.backend.url(self._blob_name_for(name), *args, **kwargs)
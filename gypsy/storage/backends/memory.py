@@ -1,42 +1,185 @@
 """
 Memory backed storage backend for Django.
 
-This backend is for running tests only. Files are lost when the process dies.
+This backend is for running tests or as a bounded in-process blob cache.
+Files are lost when the process dies. Each file is held as a single
+immutable string which is shared by every handle opened on it. If max_size
+is given the least recently used files are dropped to keep the total size
+under it.
 """
 
-from cStringIO import StringIO
+from bisect import bisect_left, insort
+from collections import OrderedDict
 
 from django.core.files.storage import Storage
 
+class MemoryFile(object):
+    """Read only handle on a stored string. Opening doesn't copy the data."""
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, num_bytes=None):
+        start = self._pos
+        if num_bytes is None or num_bytes < 0:
+            self._pos = len(self._data)
+        else:
+            self._pos = min(start + num_bytes, len(self._data))
+        # Slicing the whole string returns the string itself rather than a copy
+        return self._data[start:self._pos]
+
+    def getbuffer(self):
+        """Return a memoryview of the data from the current position without copying it."""
+        return memoryview(self._data)[self._pos:]
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._pos
+        elif whence == 2:
+            position += len(self._data)
+        if position < 0:
+            raise IOError("Invalid seek position %d" % position)
+        self._pos = position
+
+    def tell(self):
+        return self._pos
+
+    def chunks(self, chunk_size=64*1024):
+        self.seek(0)
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def __iter__(self):
+        return iter(self.read().splitlines(True))
+
+    def close(self):
+        self.closed = True
+
+    def write(self, content):
+        raise NotImplementedError("MemoryFile doesn't implement write")
+
 class MemoryStorage(Storage):
-    def __init__(self):
+    def __init__(self, max_size=None):
         self.files = {}
+        self.max_size = max_size
+        self.total_size = 0
+        self.evictions = 0
+        self._names = [] # Sorted index of names for listing
+        self._last_used = OrderedDict() # Names from least to most recently used
 
     def _open(self, name, mode='rb'):
-        return StringIO(self.files[name])
+        data = self.files[name]
+        self._touch(name)
+        return MemoryFile(name, data)
 
     def _save(self, name, content):
-        self.files[name] = content.read()
+        if hasattr(content, 'read'):
+            # One read allocates the data once, joining chunks would hold
+            # the chunks and the joined copy at the same time
+            if hasattr(content, 'seek'):
+                content.seek(0)
+            data = content.read()
+        else:
+            data = "".join(content.chunks())
+
+        if name in self.files:
+            self.total_size -= len(self.files[name])
+        else:
+            insort(self._names, name)
+        self.files[name] = data
+        self.total_size += len(data)
+        self._touch(name)
+
+        if self.max_size is not None and self.total_size > self.max_size:
+            self._evict(keep=name)
         return name
 
+    def _touch(self, name):
+        self._last_used.pop(name, None)
+        self._last_used[name] = True
+
+    def _evict(self, keep):
+        """Drop the least recently used files other than keep until under max_size."""
+        while self.total_size > self.max_size:
+            name = next(iter(self._last_used))
+            if name == keep:
+                # keep was just touched so everything else is gone
+                break
+            self._remove(name)
+            self.evictions += 1
+
     # def get_valid_name(self, name):
     #     return name
 
     def delete(self, name):
-        del self.files[name]
+        if name not in self.files:
+            raise KeyError(name)
+        self._remove(name)
+
+    def delete_many(self, names):
+        for name in names:
+            if name in self.files:
+                self._remove(name)
+
+    def _remove(self, name):
+        self.total_size -= len(self.files.pop(name))
+        del self._last_used[name]
+        del self._names[bisect_left(self._names, name)]
 
     def exists(self, name):
         return name in self.files
 
+    def exists_many(self, names):
+        return set(name for name in names if name in self.files)
+
     def size(self, name):
         return len(self.files[name])
 
-    # def listdir(self, path):
-    #     """
-    #     Lists the contents of the specified path, returning a 2-tuple of lists;
-    #     the first item being directories, the second item being files.
-    #     """
-    #     raise NotImplementedError()
+    def listdir(self, path):
+        """
+        Lists the contents of the specified path, returning a 2-tuple of lists;
+        the first item being directories, the second item being files.
+        """
+        directories, files = [], []
+        for name, is_dir in self.iter_listdir(path):
+            (directories if is_dir else files).append(name)
+        return directories, files
+
+    def iter_listdir(self, path):
+        """Yield (name, is_directory) for the contents of path."""
+        prefix = path
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        i = bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            rest = self._names[i][len(prefix):]
+            slash = rest.find('/')
+            if slash < 0:
+                yield rest, False
+                i += 1
+            else:
+                yield rest[:slash], True
+                # '0' sorts right after '/' so this skips everything in the directory
+                i = bisect_left(self._names, prefix + rest[:slash] + '0', i)
+
+    def iter_keys(self, prefix=''):
+        """Yield the names of all files starting with prefix."""
+        i = bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            yield self._names[i]
+            i += 1
 
     def url(self, name, expires_in=None):
         return "TODO"
@@ -8,28 +8,51 @@ Settings are specified in settings.STORAGE_S3:
     PUBLIC = If all files should be world readable (default is False)
     CNAME = True if urls should use the bucket name as the domain (cname) instead of s3.amazonaws.com/bucket/ (default is False)
     URL_TIMEOUT = Default timeout for urls (default is no timeout)
+    URL_EXPIRY_WINDOW = Seconds to round expiring urls up to so they can be reused (default is a quarter of the timeout)
+    FAST_SAVE = Set the ACL with the upload and check the returned ETag instead of looking up the key again (default is False)
+    READ_AHEAD = Bytes to buffer for small reads from opened files (default is 64KB)
+    MULTIPART_THRESHOLD = Files at least this many bytes are sent as a multipart upload (default is no multipart)
+    MULTIPART_CHUNK_SIZE = Size of each part of a multipart upload (default and minimum is 5MB)
+    MULTIPART_THREADS = Number of parts to upload at the same time (default is 4)
 
 The Content object passed to save can include the following attributes:
     public = If the file should be world readable
+    mimetype = Content type to store instead of guessing it from the name
     backend_headers = Dictionary of optional HTTP headers
 """
 
+import os
+import sys
+import hmac
 import logging
-from time import sleep
+import threading
+from Queue import Queue
+from cStringIO import StringIO
+from base64 import b64encode
+from hashlib import sha1
+from time import sleep, time
 from urllib import quote
 from httplib import BadStatusLine
 
-from boto.exception import S3ResponseError
+from boto.exception import S3ResponseError, S3DataError
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
+from boto.s3.prefix import Prefix
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
 
 from django.conf import settings
+from django.core import signals
 from django.core.files.base import File
 from django.core.files.storage import Storage
 
 from gypsy.utils.mimetype import guess_type
 
+MIN_CHUNK_SIZE = 5 * 1024 * 1024 # S3 rejects smaller parts (except the last)
+DEFAULT_READ_AHEAD = 64 * 1024
+MAX_DELETE_KEYS = 1000 # Most keys S3 accepts in a single multi-object delete
+MAX_CACHED_URLS = 10000
+
 def retry(func, *args, **kwargs):
     """retry all commands a few times func because S3 occasionally returns 500 errors"""
     retry_sleep = 0.2
@@ -49,15 +72,121 @@ def retry(func, *args, **kwargs):
 
     raise last_error
 
+def key_name(key):
+    """Return a listed key's name as unicode. boto's parser already decodes most of them."""
+    if isinstance(key.name, str):
+        return key.name.decode('utf-8')
+    return key.name
+
+class S3ConnectionPool(object):
+    """
+    Process wide pool of S3 connections keyed by credentials.
+
+    boto connections aren't thread safe so a thread checks out its own
+    connection the first time it needs one and keeps it until it calls
+    release(), after which the connection (and its keep-alive socket) is
+    handed to the next thread that asks. Request threads release theirs
+    at the end of every request. Creating connections and bucket
+    objects makes no requests, and each bucket is only validated once per
+    process the first time it's used.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = {}
+        self._validated = set()
+        self.created = 0
+        self.reused = 0
+
+    @property
+    def reuse_rate(self):
+        total = self.created + self.reused
+        return total and float(self.reused) / total or 0.0
+
+    def get(self, api_key, secret_key):
+        """Return the current thread's connection for the credentials."""
+        conns = self._local.__dict__.setdefault('conns', {})
+        key = (api_key, secret_key)
+        conn = conns.get(key)
+        if conn is None:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    self.reused += 1
+                else:
+                    self.created += 1
+            finally:
+                self._lock.release()
+            if conn is None:
+                conn = S3Connection(api_key, secret_key)
+            conns[key] = conn
+        return conn
+
+    def get_bucket(self, api_key, secret_key, bucket_name):
+        """Return a bucket bound to the current thread's connection."""
+        buckets = self._local.__dict__.setdefault('buckets', {})
+        key = (api_key, secret_key, bucket_name)
+        bucket = buckets.get(key)
+        if bucket is None:
+            conn = self.get(api_key, secret_key)
+            if key not in self._validated:
+                try:
+                    conn.get_bucket(bucket_name)
+                except S3ResponseError, exc:
+                    if exc.status != 404:
+                        raise
+                    conn.create_bucket(bucket_name) # Can raise boto.exception.S3CreateError
+                self._validated.add(key)
+            bucket = buckets[key] = Bucket(conn, bucket_name)
+        return bucket
+
+    def release(self):
+        """Return the current thread's connections to the pool."""
+        conns = self._local.__dict__.pop('conns', {})
+        self._local.__dict__.pop('buckets', None)
+        self._lock.acquire()
+        try:
+            for key, conn in conns.items():
+                self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+connection_pool = S3ConnectionPool()
+
+def release_connections(**kwargs):
+    connection_pool.release()
+
+signals.request_finished.connect(release_connections)
+
 class S3File(File):
-    def __init__(self, bucket, name):
+    """
+    Read only file backed by an S3 key. Sequential reads are streamed from
+    one GET. A read after a seek asks for a bounded Range of at least
+    read_ahead bytes, so random access never downloads more than that, and
+    once a read continues past that range the rest of the file is streamed
+    again. Responses that are abandoned are closed without reading them.
+    Reads smaller than read_ahead are served from a buffer so small
+    sequential reads and short seeks don't hit the network. requests and
+    bytes_fetched count the GETs made and the bytes read from them.
+    """
+    def __init__(self, bucket, name, read_ahead=DEFAULT_READ_AHEAD):
         self._bucket = bucket
         self._name = name
         self._key = Key(bucket=bucket, name=name.encode('utf-8'))
         self._pos = 0
-        self._open = False
+        self._size = None
+        self._stream_pos = None # Offset of the open response or None if there isn't one
+        self._stream_end = None # End of the requested range or None if it's open ended
+        self._next_pos = 0 # Offset after the last byte read, reading from here is sequential
+        self._buffer = ""
+        self._buffer_pos = 0
         self._fake_open = False
         self._mode = 'r'
+        self.read_ahead = read_ahead
+        self.requests = 0
+        self.bytes_fetched = 0
 
     @property
     def name(self):
@@ -71,80 +200,174 @@ class S3File(File):
     def closed(self):
         return self._fake_open
 
-    def size():
-        doc = "The size property."
-        def fget(self):
-            raise NotImplementedError("S3File doesn't implement size and __len__")
-        def fset(self, value):
-            raise NotImplementedError("S3File doesn't implement size and __len__")
-        return locals()
+    def _get_size(self):
+        if self._size is None:
+            key = retry(self._bucket.get_key, self._key.name)
+            if key is None:
+                raise IOError("No such file: '%s'" % self._name)
+            self._size = key.size
+        return self._size
+    size = property(_get_size)
 
     def open(self, mode="r"):
         self.close()
+        self._pos = 0
+        self._next_pos = 0
         self._mode = (mode or 'r')[0]
         self._fake_open = True
 
     def close(self):
-        if self._open:
-            self._pos = 0
-            self._key.close()
+        self._drop_stream()
+        self._buffer = ""
         self._fake_open = False
 
-    def seek(self, position):
-        if position != 0:
-            raise NotImplementedError("S3File doesn't implement seek at positions other than 0")
-        if self._pos != 0:
-            # TODO: This is a bit flakey I imagine
-            self._key.resp = None
-            self._pos = 0
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._pos
+        elif whence == 2:
+            position += self.size
+        if position < 0:
+            raise IOError("Invalid seek position %d" % position)
+        self._pos = position
 
     def tell(self):
         return self._pos
 
     def read(self, num_bytes=None):
-        if not self._open:
-            self._key.open(self._mode)
-            self._open = True
-        data = self._key.read(num_bytes)
-        self._pos += len(data)
+        if num_bytes is not None and num_bytes < 0:
+            num_bytes = None
+
+        chunks = []
+        while num_bytes is None or num_bytes > 0:
+            if self._size is not None and self._pos >= self._size:
+                break
+
+            offset = self._pos - self._buffer_pos
+            if 0 <= offset < len(self._buffer):
+                if num_bytes is None:
+                    data = self._buffer[offset:]
+                else:
+                    data = self._buffer[offset:offset + num_bytes]
+            elif num_bytes is not None and num_bytes < self.read_ahead:
+                self._buffer_pos = self._pos
+                self._buffer = self._read_stream(self.read_ahead)
+                if not self._buffer:
+                    break
+                continue
+            else:
+                data = self._read_stream(num_bytes)
+
+            if not data:
+                break
+            chunks.append(data)
+            self._pos += len(data)
+            if num_bytes is not None:
+                num_bytes -= len(data)
+
+        return "".join(chunks)
+
+    def _read_stream(self, num_bytes):
+        """Read from the open response, requesting a new range at the current position if necessary."""
+        if self._stream_pos != self._pos or self._stream_pos == self._stream_end:
+            self._drop_stream()
+            if num_bytes is None or self._pos == self._next_pos:
+                self._stream_end = None
+                headers = {'Range': 'bytes=%d-' % self._pos}
+            else:
+                self._stream_end = self._pos + max(num_bytes, self.read_ahead)
+                headers = {'Range': 'bytes=%d-%d' % (self._pos, self._stream_end - 1)}
+            try:
+                retry(self._key.open_read, headers=headers)
+            except S3ResponseError, exc:
+                if exc.status == 416: # Requested range not satisfiable (past the end)
+                    return ""
+                raise
+            self.requests += 1
+            self._stream_pos = self._pos
+            self._size_from_response(self._key.resp)
+
+        if num_bytes is not None and self._stream_end is not None:
+            num_bytes = min(num_bytes, self._stream_end - self._stream_pos)
+        data = self._key.resp.read(num_bytes)
+        self._stream_pos += len(data)
+        self._next_pos = self._stream_pos
+        self.bytes_fetched += len(data)
+        if not data or self._stream_pos == self._stream_end:
+            # Nothing is left of the response so closing it reads nothing
+            self._key.close()
+            self._stream_pos = None
         return data
 
+    def _drop_stream(self):
+        """Forget the open response without reading the rest of it."""
+        try:
+            self._key.close(fast=True)
+        except TypeError:
+            # boto before 2.25 always reads the rest so close the response
+            # here. The next request on the connection then fails with
+            # BadStatusLine, which retry() handles by reconnecting.
+            if self._key.resp is not None:
+                self._key.resp.close()
+            self._key.resp = None
+            self._key.mode = None
+            self._key.closed = True
+        self._stream_pos = None
+
+    def _size_from_response(self, resp):
+        # Content-Range looks like "bytes 100-199/1234"
+        content_range = resp.getheader('content-range')
+        if content_range:
+            total = content_range.rsplit('/', 1)[-1]
+            if total.isdigit():
+                self._size = int(total)
+        else:
+            length = resp.getheader('content-length')
+            if length and length.isdigit():
+                self._size = int(length)
+
     def write(self, content):
         raise NotImplementedError("S3File doesn't implement write")
 
     def flush(self):
         raise NotImplementedError("S3File doesn't implement flush")
 
-    def close(self):
-        self._key.close()
-
 
 class S3Storage(Storage):
-    def __init__(self, bucket=None, api_key=None, secret_key=None, url_timeout=None, cname=None, public=None, overwrite=None):
+    def __init__(self, bucket=None, api_key=None, secret_key=None, url_timeout=None, cname=None, public=None, overwrite=None,
+                 multipart_threshold=None, multipart_chunk_size=None, multipart_threads=None, read_ahead=None,
+                 fast_save=None, url_expiry_window=None):
         self.api_key = api_key or settings.STORAGE_S3['API_KEY']
         self.secret_key = secret_key or settings.STORAGE_S3['SECRET_KEY']
 
         self.public = public if public is not None else settings.STORAGE_S3.get('PUBLIC', False)
         self.bucket_name = bucket or settings.STORAGE_S3['BUCKET']
         self.url_timeout = url_timeout or settings.STORAGE_S3.get('URL_TIMEOUT')
+        self.url_expiry_window = url_expiry_window or settings.STORAGE_S3.get('URL_EXPIRY_WINDOW')
+        self._url_cache = {}
         self.cname = cname if cname is not None else settings.STORAGE_S3.get('CNAME', False)
         self.overwrite = overwrite if overwrite is not None else settings.STORAGE_S3.get('OVERWRITE', False)
+        self.fast_save = fast_save if fast_save is not None else settings.STORAGE_S3.get('FAST_SAVE', False)
+        self.multipart_threshold = multipart_threshold or settings.STORAGE_S3.get('MULTIPART_THRESHOLD')
+        self.multipart_chunk_size = max(MIN_CHUNK_SIZE, multipart_chunk_size or settings.STORAGE_S3.get('MULTIPART_CHUNK_SIZE', 0))
+        self.multipart_threads = multipart_threads or settings.STORAGE_S3.get('MULTIPART_THREADS', 4)
+        self.read_ahead = read_ahead or settings.STORAGE_S3.get('READ_AHEAD', DEFAULT_READ_AHEAD)
 
-        self.conn = S3Connection(self.api_key, self.secret_key)
+    @property
+    def conn(self):
+        return connection_pool.get(self.api_key, self.secret_key)
 
-        self.bucket = self.conn.get_bucket(self.bucket_name)
-        if not self.bucket:
-            self.bucket = self.conn.create_bucket(bucket) # Can raise boto.exception.S3CreateError
-            # self.bucket.set_acl('public-read')
+    @property
+    def bucket(self):
+        return connection_pool.get_bucket(self.api_key, self.secret_key, self.bucket_name)
 
     def _open(self, name, mode='rb'):
-        s3file = S3File(self.bucket, name)
+        s3file = S3File(self.bucket, name, self.read_ahead)
         s3file.open(mode)
         return s3file
 
     def _save(self, name, content, mimetype=None, public=None):
         if not mimetype:
-            mimetype = guess_type(name)[0] or "application/x-binary"
+            mimetype = getattr(content, 'mimetype', None) or guess_type(name)[0] or "application/x-binary"
 
         if hasattr(content, 'public'):
             public = content.public
@@ -155,11 +378,33 @@ class S3Storage(Storage):
         key.content_type = mimetype
         headers = getattr(content, 'backend_headers', {})
 
+        multipart = self.multipart_threshold and content.size >= self.multipart_threshold
         success = False
 
+        if self.fast_save and public:
+            headers = dict(headers, **{'x-amz-acl': 'public-read'})
+
         for i in range(3):
-            content.seek(0)
-            retry(key.set_contents_from_file, content, headers=headers)
+            if multipart:
+                self._save_multipart(name, content, dict(headers, **{'Content-Type': mimetype}))
+            else:
+                content.seek(0)
+                md5 = self.fast_save and key.compute_md5(content) or None
+                content.seek(0)
+                try:
+                    retry(key.set_contents_from_file, content, headers=headers, md5=md5)
+                except S3DataError:
+                    logging.warning(u"Failed to write to S3 (checksum mismatch): %s" % name)
+                    continue
+
+            if self.fast_save:
+                # The ACL was sent with the upload and S3 only completes a
+                # multipart upload after checking every part's ETag.
+                success = multipart or key.etag.strip('"') == md5[0]
+                if success:
+                    break
+                logging.warning(u"Failed to write to S3 (checksum mismatch): %s" % name)
+                continue
 
             if public:
                 try:
@@ -170,7 +415,6 @@ class S3Storage(Storage):
                     raise
 
             # Make sure file actually exists on S3
-            # TODO: Maybe only do this if not settings the acl as that should have the same effect?
             success = bool(retry(self.bucket.lookup, name.encode('utf-8')))
             if success:
                 break
@@ -182,6 +426,75 @@ class S3Storage(Storage):
 
         return name
 
+    def _save_multipart(self, name, content, headers):
+        """Upload content as a multipart upload retrying only the parts that fail."""
+        mp = retry(self.bucket.initiate_multipart_upload, name.encode('utf-8'), headers=headers)
+        try:
+            part_count = max(1, (content.size + self.multipart_chunk_size - 1) // self.multipart_chunk_size)
+            pending = range(1, part_count + 1)
+            for i in range(3):
+                pending = self._upload_parts(mp, content, pending)
+                if not pending:
+                    break
+                logging.warning(u"Failed to upload %d parts of %s to S3" % (len(pending), name))
+            if pending:
+                raise Exception("Failed to write parts %s of file '%s'" % (pending, name))
+            retry(mp.complete_upload)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                retry(mp.cancel_upload)
+            except Exception:
+                logging.exception(u"Failed to cancel multipart upload of %s" % name)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _upload_parts(self, mp, content, part_nums):
+        """
+        Upload the given parts of content using a pool of threads and return
+        the part numbers that failed. Content is read by the calling thread
+        into a bounded queue so at most about twice multipart_threads parts
+        are held in memory at once.
+        """
+        parts = Queue(self.multipart_threads)
+        failed = []
+
+        def worker():
+            # Each worker checks out its own connection from the pool
+            upload = None
+            try:
+                while True:
+                    part = parts.get()
+                    if part is None:
+                        break
+                    part_num, data = part
+                    try:
+                        if upload is None:
+                            upload = MultiPartUpload(self.bucket)
+                            upload.key_name = mp.key_name
+                            upload.id = mp.id
+                        retry(upload.upload_part_from_file, StringIO(data), part_num)
+                    except Exception:
+                        logging.exception(u"Failed to upload part %d of %s to S3" % (part_num, mp.key_name))
+                        failed.append(part_num)
+            finally:
+                connection_pool.release()
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.multipart_threads, len(part_nums)))]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        try:
+            for part_num in part_nums:
+                content.seek((part_num - 1) * self.multipart_chunk_size)
+                parts.put((part_num, content.read(self.multipart_chunk_size)))
+        finally:
+            for t in threads:
+                parts.put(None)
+            for t in threads:
+                t.join()
+
+        return sorted(failed)
+
     # def get_valid_name(self, name):
     #     name = super(S3Storage, self).get_valid_name(name)
     #     if isinstance(name, unicode):
@@ -196,40 +509,175 @@ class S3Storage(Storage):
     def delete(self, name):
         return retry(self.bucket.delete_key, name.encode('utf-8'))
 
+    def delete_many(self, names):
+        """Delete names in multi-object delete requests of up to MAX_DELETE_KEYS keys."""
+        names = [name.encode('utf-8') for name in names]
+        for i in range(0, len(names), MAX_DELETE_KEYS):
+            result = retry(self.bucket.delete_keys, names[i:i+MAX_DELETE_KEYS], quiet=True)
+            if result.errors:
+                raise Exception("Failed to delete files: %s" % ", ".join(
+                    "%s (%s)" % (err.key, err.code) for err in result.errors))
+
     def exists(self, name):
         return bool(retry(self.bucket.lookup, name.encode('utf-8')))
 
-    # def size(self, name):
-    #     pass
+    def exists_many(self, names):
+        """
+        Return the set of names that exist. Names are grouped by directory and
+        each group is answered by listing the directory from just before the
+        next wanted name, so one request covers every wanted name among the
+        next thousand keys and the keys in between are skipped. A name that
+        is left on its own gets a HEAD request instead.
+        """
+        groups = {}
+        for name in names:
+            name = unicode(name)
+            groups.setdefault(name[:name.rfind('/')+1], set()).add(name)
+
+        existing = set()
+        for prefix, wanted in groups.items():
+            existing.update(self._list_matching(prefix, wanted))
+        return existing
+
+    def _list_matching(self, prefix, wanted):
+        """Return the names in wanted that exist under prefix."""
+        # Everything is compared as unicode, which sorts like S3's UTF-8 keys
+        pending = sorted(wanted)
+        found = []
+        last = u''
+        while pending:
+            if len(pending) == 1:
+                if retry(self.bucket.get_key, pending[0].encode('utf-8')) is not None:
+                    found.append(pending[0])
+                break
 
-    # def listdir(self, path):
-    #     """
-    #     Lists the contents of the specified path, returning a 2-tuple of lists;
-    #     the first item being directories, the second item being files.
-    #     """
-    #     raise NotImplementedError()
+            # Listings start after the marker. The name without its last
+            # character sorts just before the name; never go back over a
+            # page that was already listed.
+            marker = max(last, pending[0][:-1])
+            page = retry(self.bucket.get_all_keys, prefix=prefix.encode('utf-8'), delimiter='/',
+                marker=marker.encode('utf-8'))
+            for key in page:
+                if isinstance(key, Prefix):
+                    # Common prefixes come after the keys, not in order
+                    continue
+                name = key_name(key)
+                while pending and pending[0] < name:
+                    pending.pop(0)
+                if not pending:
+                    break
+                if pending[0] == name:
+                    found.append(pending.pop(0))
+            if not page.is_truncated or not len(page):
+                break
+            # Skip whatever is left of the page's range
+            last = page.next_marker or max(key.name for key in page)
+            if isinstance(last, str):
+                last = last.decode('utf-8')
+            while pending and pending[0] <= last:
+                pending.pop(0)
+        return found
+
+    def size(self, name):
+        return self._head(name).size
+
+    def etag(self, name):
+        return self._head(name).etag
+
+    def _head(self, name):
+        key = retry(self.bucket.get_key, name.encode('utf-8'))
+        if key is None:
+            raise IOError("No such file: '%s'" % name)
+        return key
+
+    def listdir(self, path):
+        """
+        Lists the contents of the specified path, returning a 2-tuple of lists;
+        the first item being directories, the second item being files.
+        """
+        directories, files = [], []
+        for name, is_dir in self.iter_listdir(path):
+            (directories if is_dir else files).append(name)
+        return directories, files
+
+    def iter_listdir(self, path):
+        """Yield (name, is_directory) for the contents of path fetching one page at a time."""
+        prefix = path
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        for key in self._iter_list(prefix.encode('utf-8'), '/'):
+            name = key_name(key)[len(prefix):]
+            if isinstance(key, Prefix):
+                yield name.rstrip('/'), True
+            else:
+                yield name, False
+
+    def iter_keys(self, prefix=''):
+        """Yield the names of all files starting with prefix fetching one page at a time."""
+        for key in self._iter_list(prefix.encode('utf-8')):
+            yield key_name(key)
+
+    def _iter_list(self, prefix, delimiter=''):
+        """Page through a bucket listing retrying each request."""
+        marker = ''
+        while True:
+            page = retry(self.bucket.get_all_keys, prefix=prefix, delimiter=delimiter, marker=marker)
+            for key in page:
+                yield key
+            if not page.is_truncated or not len(page):
+                break
+            marker = page.next_marker or page[-1].name
+            if isinstance(marker, unicode):
+                marker = marker.encode('utf-8')
 
     def url(self, name, expires_in=None):
-        if expires_in or self.url_timeout:
-            key = Key(self.bucket, name.encode('utf-8'))
-            url = retry(key.generate_url, expires_in=expires_in or self.url_timeout)
-        else:
-            if self.cname:
-                url = "http://%s/%s" % (
-                    self.bucket.name,
-                    quote(name.encode('utf-8')))
-            else:
-                url = "%s://%s/%s/%s" % (
-                    self.conn.protocol,
-                    force_string(self.conn.server_name),
-                    force_string(self.bucket_name),
-                    quote(name.encode('utf-8')))
-                url = url.replace('https://', 'http://').replace(':443/', '/')
-        if url and url.startswith('http://'):
-            url = url.replace(':80/', '/')
-        elif url and url.startswith('https://'):
-            url = url.replace(':443/', '/')
-        return url
+        return self.urls([name], expires_in)[0]
+
+    def urls(self, names, expires_in=None):
+        """
+        Return urls for names. Expiring urls are signed locally and their
+        expiry time is rounded up to the next url_expiry_window, so the same
+        url is handed out (and cached by browsers and CDNs) for the whole
+        window. Signed urls are cached for the window as well.
+        """
+        expires_in = expires_in or self.url_timeout
+        if not expires_in:
+            return [self._public_url(name) for name in names]
+
+        window = self.url_expiry_window or max(1, expires_in // 4)
+        expires = (int(time()) + expires_in) // window * window + window
+        if len(self._url_cache) > MAX_CACHED_URLS:
+            self._url_cache.clear()
+
+        urls = []
+        for name in names:
+            cache_key = (name, expires)
+            url = self._url_cache.get(cache_key)
+            if url is None:
+                url = self._url_cache[cache_key] = self._signed_url(name, expires)
+            urls.append(url)
+        return urls
+
+    def _base_url(self):
+        if self.cname:
+            return "http://%s/" % self.bucket_name
+        url = "%s://%s/%s/" % (
+            self.conn.protocol,
+            force_string(self.conn.server_name),
+            force_string(self.bucket_name))
+        return url.replace(':443/', '/').replace(':80/', '/')
+
+    def _public_url(self, name):
+        return (self._base_url() + quote(name.encode('utf-8'))).replace('https://', 'http://')
+
+    def _signed_url(self, name, expires):
+        """Sign a query string authenticated GET url (AWS signature version 2)."""
+        path = quote(name.encode('utf-8'))
+        # Settings can hold unicode which hmac can't take as a key
+        string_to_sign = ("GET\n\n\n%d\n/%s/%s" % (expires, self.bucket_name, path)).encode('utf-8')
+        signature = b64encode(hmac.new(self.secret_key.encode('utf-8'), string_to_sign, sha1).digest())
+        return "%s%s?AWSAccessKeyId=%s&Expires=%d&Signature=%s" % (
+            self._base_url(), path, quote(self.api_key.encode('utf-8'), safe=''), expires, quote(signature, safe=''))
 
 def force_string(v):
     if hasattr(v, '__call__'):
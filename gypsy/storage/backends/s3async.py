@@ -0,0 +1,155 @@
+"""
+Concurrent front end for S3Storage.
+
+Operations run on a bounded pool of worker threads and immediately return
+an AsyncResult, so one process can have many S3 requests in flight while
+it carries on with other work. Each worker checks out its own pooled
+connection and returns it to the pool when the storage is closed, and
+retry backoff only holds up the worker that is retrying.
+
+Reads are done entirely on the workers: read() fetches a byte range,
+open() downloads the whole file and iter_chunks() streams a file as
+ranged reads that are kept concurrency requests ahead of the consumer.
+
+Settings are specified in settings.STORAGE_S3 (see gypsy.storage.backends.s3):
+    CONCURRENCY = Number of operations to run at the same time (default is 16)
+"""
+
+import sys
+import threading
+from Queue import Queue
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from gypsy.storage.backends.s3 import S3Storage, connection_pool
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+class Timeout(Exception):
+    pass
+
+class AsyncResult(object):
+    """The pending result of an operation."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def ready(self):
+        return self._event.isSet()
+
+    def get(self, timeout=None):
+        """Wait for the operation to finish and return its value or raise its exception."""
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise Timeout()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def _set(self, value=None, exc_info=None):
+        self._value = value
+        self._exc_info = exc_info
+        self._event.set()
+
+class AsyncS3Storage(object):
+    def __init__(self, storage=None, concurrency=None, **kwargs):
+        self.storage = storage or S3Storage(**kwargs)
+        self.concurrency = concurrency or settings.STORAGE_S3.get('CONCURRENCY', 16)
+        self._jobs = Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _submit(self, func, *args, **kwargs):
+        if len(self._workers) < self.concurrency:
+            self._start_workers()
+        result = AsyncResult()
+        self._jobs.put((result, func, args, kwargs))
+        return result
+
+    def _start_workers(self):
+        self._lock.acquire()
+        try:
+            while len(self._workers) < self.concurrency:
+                worker = threading.Thread(target=self._work)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                result, func, args, kwargs = job
+                try:
+                    result._set(func(*args, **kwargs))
+                except:
+                    result._set(exc_info=sys.exc_info())
+        finally:
+            connection_pool.release()
+
+    def close(self):
+        """Stop the workers once the queued operations are done."""
+        self._lock.acquire()
+        try:
+            for worker in self._workers:
+                self._jobs.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+        finally:
+            self._lock.release()
+
+    def _read(self, name, start, length):
+        f = self.storage.open(name)
+        try:
+            if start:
+                f.seek(start)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def read(self, name, start=0, length=None):
+        """Read length bytes (or the rest of the file) of name from start."""
+        return self._submit(self._read, name, start, length)
+
+    def open(self, name, mode='rb'):
+        """Download name and return it as a ContentFile."""
+        return self._submit(lambda: ContentFile(self._read(name, 0, None)))
+
+    def iter_chunks(self, name, chunk_size=DEFAULT_CHUNK_SIZE, ahead=None):
+        """Yield the content of name in order while up to ahead (default is concurrency) chunks download."""
+        ahead = ahead or self.concurrency
+        size = self.size(name).get()
+        pending = []
+        start = 0
+        while start < size or pending:
+            while start < size and len(pending) < ahead:
+                pending.append(self.read(name, start, min(chunk_size, size - start)))
+                start += chunk_size
+            yield pending.pop(0).get()
+
+    def save(self, name, content):
+        return self._submit(self.storage.save, name, content)
+
+    def delete(self, name):
+        return self._submit(self.storage.delete, name)
+
+    def exists(self, name):
+        return self._submit(self.storage.exists, name)
+
+    def size(self, name):
+        return self._submit(self.storage.size, name)
+
+    def url(self, name, expires_in=None):
+        return self._submit(self.storage.url, name, expires_in)
+
+    def map(self, method, names, *args):
+        """Start method for every name and return the list of AsyncResults."""
+        func = getattr(self, method)
+        return [func(name, *args) for name in names]
@@ -1 +1,14 @@
-"""Only exists so storage can be an app in Django so tests run."""
\ No newline at end of file
+"""
+Models used by the storage backends. This also lets storage be an app in
+Django so tests run.
+"""
+
+from django.db import models
+
+class BlobName(models.Model):
+    """Maps a file name to the digest of the content stored by DedupStorage."""
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=40, db_index=True)
+
+    def __unicode__(self):
+        return u"%s -> %s" % (self.name, self.digest)
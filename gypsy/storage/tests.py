@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import shutil
+import tempfile
+
 from django.test import TestCase
 from django.test.client import Client
 from django.conf import settings
 from django.core.files.base import ContentFile
 
+from gypsy.storage.backends.cached import CachedStorage
+from gypsy.storage.backends.dedup import DedupStorage
 from gypsy.storage.backends.memory import MemoryStorage
 
 class StorageTestCase(TestCase):
@@ -18,12 +23,145 @@ class StorageTestCase(TestCase):
         f = self.storage.open(name)
         self.failUnlessEqual(f.read(), content)
 
+    def testSeek(self):
+        content = "0123456789" * 100
+        name = self.storage.save("seek", ContentFile(content))
+        f = self.storage.open(name)
+        f.seek(500)
+        self.failUnlessEqual(f.read(10), content[500:510])
+        self.failUnlessEqual(f.tell(), 510)
+        f.seek(5)
+        self.failUnlessEqual(f.read(5), content[5:10])
+        f.seek(-10, 2)
+        self.failUnlessEqual(f.read(), content[-10:])
+        self.failUnlessEqual(f.read(), "")
+        self.failUnlessEqual(self.storage.size(name), len(content))
+
+    def testManyFiles(self):
+        names = [self.storage.save("many/%d" % i, ContentFile("test")) for i in range(4)]
+        names.append(self.storage.save(u"many/mit\u00e4", ContentFile("test")))
+        missing = ["many/missing", "other/missing", u"many/\u00e4"]
+        self.failUnlessEqual(self.storage.exists_many(names + missing), set(names))
+        self.storage.delete_many(names[:3] + missing)
+        self.failUnlessEqual(self.storage.exists_many(names), set(names[3:]))
+        self.storage.delete_many(names[3:])
+        self.failUnlessEqual(self.storage.exists_many(names), set())
+
+    def testListdir(self):
+        names = ["list/a", "list/b", "list/sub/c", "list/sub/deeper/d", "listing"]
+        for name in names:
+            self.storage.save(name, ContentFile("test"))
+        self.failUnlessEqual(self.storage.listdir("list"), ([u"sub"], [u"a", u"b"]))
+        self.failUnlessEqual(self.storage.listdir("list/sub/"), ([u"deeper"], [u"c"]))
+        self.failUnlessEqual(list(self.storage.iter_keys("list/")), names[:4])
+        self.storage.delete_many(names)
+
+    def testListdirUnicode(self):
+        names = [u"list/mit\u00e4/\u00e4", u"list/mit\u00e4/b\u00e4/c"]
+        for name in names:
+            self.storage.save(name, ContentFile("test"))
+        self.failUnlessEqual(self.storage.listdir(u"list/mit\u00e4"), ([u"b\u00e4"], [u"\u00e4"]))
+        self.failUnlessEqual(list(self.storage.iter_keys(u"list/")), sorted(names))
+        self.storage.delete_many(names)
+
+class MemoryStorageTestCase(TestCase):
+    def testMaxSize(self):
+        storage = MemoryStorage(max_size=10)
+        for name in ("a", "b", "c"):
+            storage.save(name, ContentFile("test"))
+            storage.open(name).read()
+        self.failUnlessEqual(storage.evictions, 1)
+        self.failIf(storage.exists("a"))
+        storage.open("b")
+        storage.save("d", ContentFile("test"))
+        self.failUnlessEqual(storage.exists_many(["a", "b", "c", "d"]), set(["b", "d"]))
+        self.failUnlessEqual(storage.total_size, 8)
+
+    def testSharedData(self):
+        storage = MemoryStorage()
+        name = storage.save("shared", ContentFile("test"))
+        self.failUnless(storage.open(name).read() is storage.open(name).read())
+        self.failUnlessEqual(storage.open(name).getbuffer()[1:3].tobytes(), "es")
+
+class CachedStorageTestCase(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.backend = MemoryStorage()
+        self.storage = CachedStorage(self.backend, location=self.location, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def testReadThrough(self):
+        name = self.storage.save("cached", ContentFile("test"))
+        self.failUnlessEqual(self.storage.open(name).read(), "test")
+        self.failUnlessEqual(self.storage.open(name).read(), "test")
+        self.failUnlessEqual((self.storage.hits, self.storage.misses), (1, 1))
+
+    def testInvalidate(self):
+        name = self.storage.save("cached", ContentFile("test"))
+        self.storage.open(name).read()
+        self.storage.delete(name)
+        name = self.storage.save(name, ContentFile("new"))
+        self.failUnlessEqual(self.storage.open(name).read(), "new")
+        self.failUnlessEqual(self.storage.misses, 2)
+
+    def testEviction(self):
+        for name in ("a", "b", "c"):
+            self.storage.save(name, ContentFile("test"))
+            self.storage.open(name).read()
+        self.failUnlessEqual(self.storage.evictions, 1)
+        self.storage.open("b").read()
+        self.storage.open("a").read()
+        self.failUnlessEqual((self.storage.hits, self.storage.misses), (1, 4))
+
+    def testTooBig(self):
+        name = self.storage.save("big", ContentFile("0123456789abc"))
+        self.failUnlessEqual(self.storage.open(name).read(), "0123456789abc")
+        self.failUnlessEqual(self.storage._total_size, 0)
+
+    def testRestart(self):
+        for name in ("a", "b"):
+            self.storage.save(name, ContentFile("test"))
+            self.storage.open(name).read()
+        storage = self.storage.__class__(self.backend, location=self.location, max_size=10)
+        self.failUnlessEqual(storage._total_size, 8)
+        storage.save("c", ContentFile("test"))
+        storage.open("c").read()
+        self.failUnlessEqual(storage.evictions, 1)
+
+class DedupStorageTestCase(TestCase):
+    def setUp(self):
+        self.backend = MemoryStorage()
+        self.storage = DedupStorage(self.backend)
+
+    def testDedup(self):
+        a = self.storage.save("a", ContentFile("test"))
+        b = self.storage.save("b", ContentFile("test"))
+        self.failUnlessEqual(self.storage.open(b).read(), "test")
+        self.failUnlessEqual(len(self.backend.files), 1)
+        self.storage.delete(a)
+        self.failUnlessEqual(self.storage.open(b).read(), "test")
+        self.failIf(self.storage.exists(a))
+        self.storage.delete(b)
+        self.failUnlessEqual(len(self.backend.files), 0)
+
+    def testMissing(self):
+        self.failUnlessRaises(IOError, self.storage.size, "missing")
+        self.failUnlessRaises(IOError, self.storage.url, "missing")
+
+    def testReplace(self):
+        name = self.storage.save("a", ContentFile("test"))
+        self.storage._save(name, ContentFile("new"))
+        self.failUnlessEqual(self.storage.open(name).read(), "new")
+        self.failUnlessEqual(len(self.backend.files), 1)
+
 if hasattr(settings, 'TEST_STORAGE_S3'):
-    from gypsy.storage.backends.s3 import S3Storage
+    from gypsy.storage.backends.s3 import S3Storage, MIN_CHUNK_SIZE, connection_pool
     class S3TestCase(StorageTestCase):
         def setUp(self):
-            kw = dict((k.lower(), v) for k, v in settings.TEST_STORAGE_S3.items())
-            self.storage = S3Storage(**kw)
+            self.kw = dict((k.lower(), v) for k, v in settings.TEST_STORAGE_S3.items())
+            self.storage = S3Storage(**self.kw)
 
         def testUnicode(self):
             name = self.storage.get_valid_name(u"mit\u00e4")
@@ -31,3 +169,71 @@ if hasattr(settings, 'TEST_STORAGE_S3'):
             self.storage.save(name, ContentFile(content))
             f = self.storage.open(name)
             self.failUnlessEqual(f.read(), content)
+
+        def testMultipart(self):
+            self.storage.multipart_threshold = MIN_CHUNK_SIZE
+            content = "".join(chr(i % 256) for i in range(256)) * (MIN_CHUNK_SIZE * 5 // 512)
+            name = self.storage.save("multipart", ContentFile(content))
+            f = self.storage.open(name)
+            self.failUnlessEqual(f.read(), content)
+            self.storage.delete(name)
+
+        def testFastSave(self):
+            self.storage.fast_save = True
+            for public in (False, True):
+                content = ContentFile("test")
+                content.public = public
+                name = self.storage.save("fastsave", content)
+                self.failUnless(self.storage.exists(name))
+                self.storage.delete(name)
+
+        def testSeekBytes(self):
+            content = "0123456789" * 100000
+            name = self.storage.save("seekbytes", ContentFile(content))
+            f = self.storage.open(name)
+            f.read_ahead = 1000
+            self.failUnlessEqual(f.read(10), content[:10])
+            f.seek(500000)
+            self.failUnlessEqual(f.read(10), content[500000:500010])
+            f.seek(10000)
+            self.failUnlessEqual(f.read(5000), content[10000:15000])
+            f.close()
+            self.failUnlessEqual((f.requests, f.bytes_fetched), (3, 7000))
+            self.storage.delete(name)
+
+        def testSequentialRequests(self):
+            content = "0123456789" * 100000
+            name = self.storage.save("sequential", ContentFile(content))
+            f = self.storage.open(name)
+            self.failUnlessEqual("".join(f.chunks(64*1024)), content)
+            self.failUnlessEqual((f.requests, f.bytes_fetched), (1, len(content)))
+            f.seek(10)
+            f.read(10)
+            self.failUnlessEqual("".join(f.read(64*1024) for i in range(5)), content[20:20+5*64*1024])
+            self.failUnlessEqual(f.requests, 3)
+            self.storage.delete(name)
+
+        def testConnectionPool(self):
+            self.storage.exists("pooled")
+            created = connection_pool.created
+            storage = S3Storage(**self.kw)
+            storage.exists("pooled")
+            self.failUnlessEqual(connection_pool.created, created)
+
+        def testAsync(self):
+            from gypsy.storage.backends.s3async import AsyncS3Storage
+            storage = AsyncS3Storage(self.storage, concurrency=4)
+            names = [storage.save("async/%d" % i, ContentFile("test")).get() for i in range(4)]
+            self.failUnlessEqual([r.get() for r in storage.map('exists', names)], [True] * 4)
+            self.failUnlessEqual(storage.open(names[0]).get().read(), "test")
+            self.failUnlessEqual(storage.read(names[0], 1, 2).get(), "es")
+            self.failUnlessEqual("".join(storage.iter_chunks(names[0], chunk_size=3)), "test")
+            for r in storage.map('delete', names):
+                r.get()
+            storage.close()
+
+        def testExpiringUrls(self):
+            names = [u"a", u"mit\u00e4"]
+            urls = self.storage.urls(names, 3600)
+            self.failUnlessEqual(urls, [self.storage.url(name, 3600) for name in names])
+            self.failUnless("Signature=" in urls[0])